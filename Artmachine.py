@@ -1,31 +1,79 @@
+import math
 import os
 import sys
-import shutil
-import base64
+import time
 
-from io import BytesIO 
+STARTED = time.perf_counter()
 
-from rembg import remove
-from PIL import Image, ImageOps, ImageFilter, ImageMath, ImageEnhance
+from PIL import Image
 
-from PySide6.QtCore import Qt, QSize, QRectF
+from document import SAVE_FORMATS, ImageDocument, decodeImage, openDraft, saveFormat
+from adjustments import POINT_MODES, brightnessImage, contrastImage, gammaImage, invertImage
+from filters import SKETCH_RADIUS
+from history import History
+from instrument import Instrumentation, note, phase
+from jobs import JobManager, PreviewScheduler
+from recipe import BACKGROUND_NAMES, TRANSPOSE_NAMES, Recipe, Step, loadRecipe, saveRecipe
+from resultcache import ResultCache
+from segmentation import BackgroundRemover
+from tiledimage import TiledImageItem, fitImage, imageToQImage
+
+from PySide6.QtCore import Qt, QSize, QRectF, QTimer, QFile, QIODevice, QResource, QEventLoop
 from PySide6.QtGui import (QIcon, QPixmap, QDoubleValidator, 
                            QValidator, QBrush, QColor,
-                           QPen, QMouseEvent, QFont)
+                           QPen, QMouseEvent, QFont, QTransform)
 from PySide6.QtWidgets import (QApplication, QMainWindow, QToolBar, QStatusBar, 
                                QFileDialog, QDialog, QVBoxLayout, QHBoxLayout, 
                                QPushButton, QLineEdit, QSlider, QGraphicsView, 
                                QGraphicsScene, QGraphicsPixmapItem, QFrame, 
                                QRadioButton, QGroupBox, QGraphicsRectItem, QLabel,
-                               QSizePolicy)
+                               QSizePolicy, QProgressBar, QListWidget, QFormLayout,
+                               QDoubleSpinBox, QSpinBox, QComboBox, QCheckBox)
+
+# Editable numeric parameters of recipe steps: (name, minimum, maximum, step size).
+RECIPE_PARAMETERS = {
+    "contrast": [("factor", 0, 2, 0.02)],
+    "brightness": [("factor", 0, 2, 0.02)],
+    "gamma": [("gamma", 0.1, 3, 0.01)],
+    "sketch": [("radius", 0.5, 20, 0.5)],
+}
+
+# Encoder settings offered when saving: (option, label, (minimum, maximum) or choices or bool).
+SAVE_PARAMETERS = {
+    "PNG": [("compress_level", "Compression", (0, 9)), ("optimize", "Optimize", bool)],
+    "JPEG": [("quality", "Quality", (1, 100)), ("progressive", "Progressive", bool),
+             ("subsampling", "Subsampling", ["4:4:4", "4:2:2", "4:2:0"])],
+    "WEBP": [("quality", "Quality", (0, 100)), ("lossless", "Lossless", bool), ("method", "Effort", (0, 6))],
+    "TIFF": [("compression", "Compression", ["raw", "tiff_lzw", "tiff_adobe_deflate", "packbits"])],
+}
+
+SAVE_FILTERS = "PNG Files (*.png);; JPG Files (*.jpg *.jpeg);; WebP Files (*.webp);; TIFF Files (*.tif *.tiff)"
+
+
+def filterExtension(name_filter):
+    # "JPG Files (*.jpg *.jpeg)" -> ".jpg"
+    patterns = name_filter[name_filter.find("(") + 1:name_filter.rfind(")")].split()
+    return patterns[0].lstrip("*") if patterns else ""
+
+# Icons, the splash image and the style sheet, compiled from resources/artmachine.qrc with
+# pyside6-rcc --binary resources/artmachine.qrc -o resources/artmachine.rcc
+QResource.registerResource(os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources", "artmachine.rcc"))
+
+
+def readResource(path):
+    file = QFile(path)
+    if not file.open(QIODevice.ReadOnly):
+        return ""
+    return bytes(file.readAll()).decode()
 
 class MainWindow(QMainWindow):
     def __init__(self, app):
         super().__init__()
         self.app = app
         self.setWindowTitle("Artmachine")
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
-        self.setStyleSheet("QMainWindow {background: rgb(50, 50, 50);}")
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
+        # One style sheet for the window and everything in it, parsed once.
+        self.setStyleSheet(readResource(":/style/artmachine.qss"))
         self.setGeometry(500, 150, 1000, 700)
 
         tool_bar = QToolBar("Toolbar")
@@ -35,70 +83,65 @@ class MainWindow(QMainWindow):
         self.viewer = Viewport(self)
         
         self.default_path = os.path.expanduser("~")+"\\Downloads\\"
-        self.cache_path = "files\\data.png"
+        self.remover = BackgroundRemover()
+        self.results = self.resultCache()
+        self.document = ImageDocument(Recipe(int(os.environ.get("ARTMACHINE_RECIPE_MB", 256)) * 2**20, self.remover,
+                                             results=self.results))
 
         self.open_path = ()
         self.save_path = ()
+        self.save_options = {}
 
         self.canvas_margin = int(100)
 
-        self.uStack = []
-        self.rStack = []
+        self.history = History(memory_budget=int(os.environ.get("ARTMACHINE_HISTORY_MB", 512)) * 2**20)
+        # ARTMACHINE_TIMINGS names a JSON lines file every operation's timings are appended to.
+        self.instrumentation = Instrumentation(path=os.environ.get("ARTMACHINE_TIMINGS") or None)
+        self.instrumentation.listeners.append(self.showTimings)
+        self.jobs = JobManager(self, self.instrumentation)
+
+        # ARTMACHINE_PROFILE (or --profile DIR) names a directory every menu action leaves a
+        # cProfile, sampled stack and allocation profile in.
+        self.profiler = None
+        if os.environ.get("ARTMACHINE_PROFILE"):
+            from profiling import ActionProfiler
+            self.profiler = ActionProfiler(os.environ["ARTMACHINE_PROFILE"], self.jobs.busy)
+            self.jobs.profiler = self.profiler
+            self.instrumentation.listeners.append(self.profiler.traceFinished)
 
         self.pixmap = None
+        self.preview = None
         self.gamma = float(1)
+        self.lossless_rotation = True
         self.rem_index = int(2)
         self.img_contrast = float(1.5)
         self.img_brightness = float(1.5)
 
         tool_bar.setIconSize(QSize(26, 26))
-        tool_bar.setStyleSheet("""
-                                QToolBar {
-                                    background-color: #323232;
-                                    border: none;
-                                }
-                                QToolButton {
-                                    background-color: transparent;
-                                    color: #CCCCCC;
-                                    border: none;
-                                    padding: 6px 6px;
-                                    font-size: 16px;
-                                }
-                                QToolButton:hover {
-                                    background-color: #505050;
-                                }
-                                QToolButton:pressed {
-                                    background-color: #727272;
-                                }
-                            """)
-        
-        status_bar.setStyleSheet("QStatusBar {color: rgb(128, 128, 128);}")
-
-        menu_bar.setStyleSheet("""
-                                QMenuBar {
-                                    background-color: #323232;
-                                    color: #CCCCCC;
-                                    font-size: 16px;
-                                }
-                                QMenuBar::item {
-                                    background-color: transparent;
-                                    padding: 4px 10px;
-                                }
-                                QMenuBar::item:selected {
-                                    background-color: #505050;
-                                }
-                                QMenu {
-                                    background-color: #2f2f2f;
-                                    border: 1px solid #3a3a3a;
-                                }
-                                QMenu::item {
-                                    color: #CCCCCC;
-                                    padding: 5px 20px;
-                                }
-                                QMenu::item:selected {
-                                    background-color: #363636;
-                                }
-                            """)
+
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumSize(160, 12)
+        self.progress_bar.setTextVisible(False)
+        self.progress_bar.hide()
+
+        self.cancel_button = QPushButton("Cancel")
+        self.cancel_button.setObjectName("cancelJob")
+        self.cancel_button.clicked.connect(self.cancelJob)
+        self.cancel_button.hide()
+
+        self.hud_label = QLabel()
+        self.hud_label.setObjectName("hud")
+        self.hud_label.hide()
+
+        status_bar.addPermanentWidget(self.hud_label)
+        status_bar.addPermanentWidget(self.progress_bar)
+        status_bar.addPermanentWidget(self.cancel_button)
+
+        self.jobs.started.connect(self.jobStarted)
+        self.jobs.progressed.connect(self.jobProgress)
+        self.jobs.stopped.connect(self.jobStopped)
+        self.jobs.failed.connect(self.jobFailed)
+
 
         file_menu = menu_bar.addMenu("File")
         edit_menu = menu_bar.addMenu("Edit")
@@ -108,95 +151,130 @@ class MainWindow(QMainWindow):
         view_menu = menu_bar.addMenu("View")
         help_menu = menu_bar.addMenu("Help")
 
-        open_action = file_menu.addAction(QIcon("sprites\\File.png"), "Open")
+        open_action = file_menu.addAction(QIcon(":/sprites/File.png"), "Open")
         open_action.setShortcut('Ctrl+O')
         open_action.setStatusTip("To open an existing image file")
-        open_action.triggered.connect(self.openFileDialog)
+        open_action.triggered.connect(self.profiled(self.openFileDialog))
 
-        save_action = file_menu.addAction(QIcon("sprites\\Save.png"), "Save")
+        save_action = file_menu.addAction(QIcon(":/sprites/Save.png"), "Save")
         save_action.setShortcut('Ctrl+S')
         save_action.setStatusTip("To save the current file")
-        save_action.triggered.connect(self.saveFile)
+        save_action.triggered.connect(self.profiled(self.saveFile))
 
-        quit_action = file_menu.addAction(QIcon("sprites\\Close.png"), "Quit")
+        export_recipe_action = file_menu.addAction("Export Recipe")
+        export_recipe_action.setStatusTip("Saves the steps applied to the image, e.g. for batch.py --recipe")
+        export_recipe_action.triggered.connect(self.profiled(self.exportRecipe))
+
+        import_recipe_action = file_menu.addAction("Apply Recipe")
+        import_recipe_action.setStatusTip("Applies the steps of a saved recipe to the current image")
+        import_recipe_action.triggered.connect(self.profiled(self.importRecipe))
+
+        lossless_action = file_menu.addAction("Lossless JPEG Rotation")
+        lossless_action.setCheckable(True)
+        lossless_action.setChecked(self.lossless_rotation)
+        lossless_action.setStatusTip("Saves JPEGs that were only rotated or flipped by changing their EXIF orientation")
+        lossless_action.toggled.connect(self.setLosslessRotation)
+
+        export_timings_action = file_menu.addAction("Export Timings")
+        export_timings_action.setStatusTip("Saves how long each operation took, as JSON lines or a Chrome trace")
+        export_timings_action.triggered.connect(self.profiled(self.exportTimings))
+
+        quit_action = file_menu.addAction(QIcon(":/sprites/Close.png"), "Quit")
         quit_action.setShortcut('Ctrl+W')
-        quit_action.triggered.connect(self.quitApp)
+        quit_action.triggered.connect(self.profiled(self.quitApp))
 
-        undo_action = edit_menu.addAction(QIcon("sprites\\Undo.png"),"Undo")
+        undo_action = edit_menu.addAction(QIcon(":/sprites/Undo.png"),"Undo")
         undo_action.setShortcut('Ctrl+Z')
         undo_action.setStatusTip("Undo the last changes")
-        undo_action.triggered.connect(self.undoCommand)
+        undo_action.triggered.connect(self.profiled(self.undoCommand))
 
-        redo_action = edit_menu.addAction(QIcon("sprites\\Redo.png"),"Redo")
+        redo_action = edit_menu.addAction(QIcon(":/sprites/Redo.png"),"Redo")
         redo_action.setShortcut('Ctrl+Shift+Z')
         redo_action.setStatusTip("Redo the undo changes")
-        redo_action.triggered.connect(self.redoCommand)
+        redo_action.triggered.connect(self.profiled(self.redoCommand))
+
+        recipe_action = edit_menu.addAction("Recipe")
+        recipe_action.setStatusTip("Change or remove any of the steps applied to the image")
+        recipe_action.triggered.connect(self.profiled(self.recipeDialog))
 
-        settings_action = edit_menu.addAction(QIcon("sprites\\Settings.png"), "Settings")
+        settings_action = edit_menu.addAction(QIcon(":/sprites/Settings.png"), "Settings")
         settings_action.setStatusTip("Enter application settings")
-        settings_action.triggered.connect(self.settingsDialog)
+        settings_action.triggered.connect(self.profiled(self.settingsDialog))
 
-        rotate_clockwise_action = transform_menu.addAction(QIcon("sprites\\Forward.png"), "Rotate 90 Clockwise") 
+        rotate_clockwise_action = transform_menu.addAction(QIcon(":/sprites/Forward.png"), "Rotate 90 Clockwise") 
         rotate_clockwise_action.setStatusTip("Rotate the image 90 clockwise")
-        rotate_clockwise_action.triggered.connect(self.rotateClockwise)
+        rotate_clockwise_action.triggered.connect(self.profiled(self.rotateClockwise))
 
-        rotate_anticlockwise_action = transform_menu.addAction(QIcon("sprites\\Backward.png"), "Rotate 90 Anti-Clockwise")
+        rotate_anticlockwise_action = transform_menu.addAction(QIcon(":/sprites/Backward.png"), "Rotate 90 Anti-Clockwise")
         rotate_anticlockwise_action.setStatusTip("Rotate the image 90 Anti-Clockwise")
-        rotate_anticlockwise_action.triggered.connect(self.rotateAnticlockwise)
+        rotate_anticlockwise_action.triggered.connect(self.profiled(self.rotateAnticlockwise))
 
-        flip_horizontal_action = transform_menu.addAction(QIcon("sprites\\Horizontal.png"), "Flip Horizontal") 
+        rotate_half_action = transform_menu.addAction("Rotate 180")
+        rotate_half_action.setStatusTip("Rotate the image 180")
+        rotate_half_action.triggered.connect(self.profiled(self.rotateHalf))
+
+        flip_horizontal_action = transform_menu.addAction(QIcon(":/sprites/Horizontal.png"), "Flip Horizontal") 
         flip_horizontal_action.setStatusTip("Flip the image horizontally")
-        flip_horizontal_action.triggered.connect(self.flipHorizontal)
+        flip_horizontal_action.triggered.connect(self.profiled(self.flipHorizontal))
 
-        flip_verical_action = transform_menu.addAction(QIcon("sprites\\Vertical.png"), "Flip Vertical")
+        flip_verical_action = transform_menu.addAction(QIcon(":/sprites/Vertical.png"), "Flip Vertical")
         flip_verical_action.setStatusTip("Flip the image vertically")
-        flip_verical_action.triggered.connect(self.flipVertical)
+        flip_verical_action.triggered.connect(self.profiled(self.flipVertical))
 
-        crop_image_action = transform_menu.addAction(QIcon("sprites\\Crop.png"), "Crop")
+        crop_image_action = transform_menu.addAction(QIcon(":/sprites/Crop.png"), "Crop")
         crop_image_action.setStatusTip("Dialog for cropping the image")
-        crop_image_action.triggered.connect(self.cropDialog)
+        crop_image_action.triggered.connect(self.profiled(self.cropDialog))
 
         gray_action = image_menu.addAction("Grayscale")
         gray_action.setStatusTip("Converts the image into Grayscale")
-        gray_action.triggered.connect(self.imageGray)
+        gray_action.triggered.connect(self.profiled(self.imageGray))
 
         invert_action = image_menu.addAction("Invert")
         invert_action.setStatusTip("Inverts the image colors")
-        invert_action.triggered.connect(self.imageInvert)
+        invert_action.triggered.connect(self.profiled(self.imageInvert))
 
         contrast_action = image_menu.addAction("Contrast")
         contrast_action.setStatusTip("Allows you to modify the image contrast")
-        contrast_action.triggered.connect(self.contrastDialog)
+        contrast_action.triggered.connect(self.profiled(self.contrastDialog))
 
         brightness_action = image_menu.addAction("Brightness")
         brightness_action.setStatusTip("Allows you to modify the image brightness")
-        brightness_action.triggered.connect(self.brightnessDialog)
+        brightness_action.triggered.connect(self.profiled(self.brightnessDialog))
+
+        gamma_action = image_menu.addAction("Gamma")
+        gamma_action.setStatusTip("Allows you to modify the image gamma")
+        gamma_action.triggered.connect(self.profiled(self.gammaDialog))
 
-        draw_action = filter_menu.addAction(QIcon("sprites\\Pencil.png"), "Picture Drawing")
+        draw_action = filter_menu.addAction(QIcon(":/sprites/Pencil.png"), "Picture Drawing")
         draw_action.setStatusTip("Applies a drawing filter to the current picture")
-        draw_action.triggered.connect(self.drawImage)
+        draw_action.triggered.connect(self.profiled(self.drawImage))
 
-        rembg_action = filter_menu.addAction(QIcon("sprites\\Remove.png"), "Background Removal")
+        rembg_action = filter_menu.addAction(QIcon(":/sprites/Remove.png"), "Background Removal")
         rembg_action.setStatusTip("Tries to remove the background from the current picture")
-        rembg_action.triggered.connect(self.rem_bgDialog)
+        rembg_action.triggered.connect(self.profiled(self.rem_bgDialog))
 
-        zoomIn_action = view_menu.addAction(QIcon("sprites\\ZoomIn.png"), "Zoom In")
+        zoomIn_action = view_menu.addAction(QIcon(":/sprites/ZoomIn.png"), "Zoom In")
         zoomIn_action.setShortcut('Ctrl+]')
         zoomIn_action.setStatusTip("Zooms into the canvas view")
-        zoomIn_action.triggered.connect(self.viewer.zoomIn)
+        zoomIn_action.triggered.connect(self.profiled(self.viewer.zoomIn))
 
-        zoomOut_action = view_menu.addAction(QIcon("sprites\\ZoomOut.png"), "Zoom Out")
+        zoomOut_action = view_menu.addAction(QIcon(":/sprites/ZoomOut.png"), "Zoom Out")
         zoomOut_action.setShortcut('Ctrl+[')
         zoomOut_action.setStatusTip("Zooms out of the canvas view")
-        zoomOut_action.triggered.connect(self.viewer.zoomOut)
+        zoomOut_action.triggered.connect(self.profiled(self.viewer.zoomOut))
         
-        reset_action = view_menu.addAction(QIcon("sprites\\Reset.png"), "Reset")
+        reset_action = view_menu.addAction(QIcon(":/sprites/Reset.png"), "Reset")
         reset_action.setShortcut('Ctrl+R')
         reset_action.setStatusTip("Resets the image to fit the canvas")
-        reset_action.triggered.connect(self.setImage)
+        reset_action.triggered.connect(self.profiled(self.setImage))
+
+        hud_action = view_menu.addAction("Performance HUD")
+        hud_action.setCheckable(True)
+        hud_action.setStatusTip("Shows the timings of the last operation in the status bar")
+        hud_action.toggled.connect(self.hud_label.setVisible)
 
         about_action = help_menu.addAction("About")
-        about_action.triggered.connect(self.aboutDialog)
+        about_action.triggered.connect(self.profiled(self.aboutDialog))
 
         self.addToolBar(Qt.RightToolBarArea, tool_bar)
         self.setStatusBar(status_bar)
@@ -207,26 +285,136 @@ class MainWindow(QMainWindow):
         tool_bar.addAction(rembg_action)
 
         self.setCentralWidget(self.viewer)
+        self.painted = False
+
+    def paintEvent(self, event):
+        super().paintEvent(event)
+        if not self.painted:
+            self.painted = True
+            QTimer.singleShot(0, self.firstPainted)
+
+    def firstPainted(self):
+        # Anything heavy and optional waits until the window is on screen: loading rembg and
+        # its model pulls in onnxruntime and friends, and would otherwise delay the first paint.
+        if os.environ.get("ARTMACHINE_STARTUP_BENCHMARK"):
+            print("first paint %.3f" % (time.perf_counter() - STARTED), flush=True)
+            self.app.quit()
+            return
+        if os.environ.get("ARTMACHINE_REMBG_WARMUP", "1") != "0":
+            self.remover.warmUpInBackground()
+
+    def profiled(self, slot):
+        return self.profiler.wrap(slot) if self.profiler is not None else slot
+
+    def addCommand(self, entry):
+        self.history.append(entry, self.document.image, self.document.state())
+
+    def addOperation(self, forward, inverse):
+        self.history.pushOperation(self.document.image, forward, inverse, self.document.state())
+
+    def addTransform(self, method):
+        self.history.pushTranspose(self.document.image, method, self.document.state())
+
+    def isBusy(self):
+        if self.jobs.busy():
+            self.statusBar().showMessage("Please wait for %s to finish" % self.jobs.name(), 3000)
+            return True
+        return False
+
+    def applyOperation(self, name, step, message, record=None):
+        self.applyRecipe(name, self.document.state() + (step,), message, record)
+
+    def applyRecipe(self, name, steps, message, record=None):
+        # Only the steps after the longest prefix the recipe still has cached are run.
+        if self.isBusy():
+            return
+
+        recipe = self.document.recipe
+        history = self.history
+        current = history.current
+
+        def render(progress):
+            # The tile diff for undo reads both whole images, so it is made here as well,
+            # off the GUI thread; the commit only appends it.
+            output = recipe.render(steps, progress)
+            entry = None
+            if record is None:
+                with phase("history"):
+                    entry = history.record(current, output)
+            return output, entry
+
+        def commit(result):
+            output, entry = result
+            self.document.setImage(output, steps)
+            with phase("history"):
+                if record is None:
+                    self.addCommand(entry)
+                else:
+                    record()
+            self.statusBar().showMessage(message, 3000)
+            self.setImage()
+
+        self.jobs.run(name, render, commit)
+
+    def jobStarted(self, name):
+        self.progress_bar.setRange(0, 0)
+        self.progress_bar.show()
+        self.cancel_button.show()
+        self.statusBar().showMessage(name + "...")
+
+    def jobProgress(self, fraction):
+        self.progress_bar.setRange(0, 100)
+        self.progress_bar.setValue(int(fraction * 100))
+
+    def jobStopped(self):
+        self.progress_bar.hide()
+        self.cancel_button.hide()
+        self.statusBar().clearMessage()
+        self.viewer.clearPreview()
+
+    def jobFailed(self, name, message):
+        self.statusBar().showMessage("%s failed: %s" % (name, message), 5000)
+        if name == "Opening":
+            self.restoreImage()
+
+    def cancelJob(self):
+        name = self.jobs.name()
+        self.jobs.cancel()
+        self.statusBar().showMessage("%s cancelled" % name, 3000)
+        if name == "Opening":
+            self.restoreImage()
 
-    def addCommand(self):
-        with open(self.cache_path, "rb") as file:
-            img = base64.b64encode(file.read())
-            self.uStack.append(base64.b64decode(img))
+    def restoreImage(self):
+        # The draft of a file that never finished opening goes; the open document comes back.
+        self.viewer.setPhoto(self.document.image)
 
     def undoCommand(self):
-        if len(self.uStack) > 1:
-            self.rStack.append(self.uStack.pop())
-            self.setImage()
+        if self.isBusy():
+            return
+        if self.history.canUndo():
+            with self.instrumentation.measure("Undo"):
+                self.restoreHistory(self.history.undo())
         else:
             self.statusBar().showMessage("Undo not available" ,3000)
 
     def redoCommand(self):
-        if len(self.rStack) > 0:
-            self.uStack.append(self.rStack.pop())
-            self.setImage()
+        if self.isBusy():
+            return
+        if self.history.canRedo():
+            with self.instrumentation.measure("Redo"):
+                self.restoreHistory(self.history.redo())
         else:
             self.statusBar().showMessage("Redo not available" ,3000)
 
+    def restoreHistory(self, image):
+        # Cached again under its steps, so the next operation starts from this state instead
+        # of rendering the whole recipe from the source once the cache has dropped it.
+        steps = self.history.state()
+        self.document.setImage(image, steps)
+        if steps:
+            self.document.recipe.store(steps, image)
+        self.setImage()
+
     def openFileDialog(self):
         self.statusBar().showMessage("Openning a file..." ,3000)
 
@@ -239,115 +427,180 @@ class MainWindow(QMainWindow):
             self.openFile(self.open_path[0])
 
     def openFile(self, path):
-        shutil.copy(path, self.cache_path)
+        # A reduced draft is shown right away and the full decode replaces it when it is done.
+        # Any other job is given up for it, but a save in progress is never thrown away.
+        if self.jobs.name() == "Saving" and self.isBusy():
+            return
+        self.jobs.cancel()
+        trace = self.instrumentation.begin("Opening")
+        screen = self.screen().size() * self.screen().devicePixelRatio()
+        try:
+            with trace.phase("draft"):
+                draft, size = openDraft(path, screen.width(), screen.height())
+                if draft is not None:
+                    self.viewer.setPhoto(draft, size=size)
+        except OSError as error:
+            self.instrumentation.finish(trace, "failed")
+            self.statusBar().showMessage("Could not open %s: %s" % (os.path.basename(path), error), 5000)
+            return
+
+        def commit(result):
+            self.document.load(path, *result)
+            with phase("history"):
+                self.history.reset(self.document.image, self.document.state())
+            self.setImage()
 
-        self.addCommand()          
-        self.setImage()
+        self.jobs.run("Opening", lambda progress: decodeImage(path), commit, trace)
 
     def saveFile(self):
+        if not self.document.hasImage():
+            self.statusBar().showMessage("No image currently open!" ,3000)
+            return
+
         self.statusBar().showMessage("Saving the file..." ,3000)
-        path = QFileDialog.getSaveFileName(self, "Save File", os.path.dirname(self.open_path[0], ), "PNG Files (*.png)")
+        path = QFileDialog.getSaveFileName(self, "Save File", os.path.dirname(self.open_path[0], ), SAVE_FILTERS)
+
+        if path[0] == "":
+            self.statusBar().showMessage("File dialog closed" ,3000)
+        elif not self.isBusy():
+            file_path = path[0]
+            if not os.path.splitext(file_path)[1]:
+                file_path += filterExtension(path[1])
+            format = saveFormat(file_path)
+            if format is None:
+                self.statusBar().showMessage("Cannot save as %s" % os.path.splitext(file_path)[1], 3000)
+                return
+
+            lossless = self.lossless_rotation and self.document.canSaveLossless(file_path)
+            options = self.save_options.get(format, SAVE_FORMATS[format][1])
+            if not lossless:
+                options_widget = ApplicationDialogs()
+                options, ok = options_widget.saveDialog(format, options, "Save Options", 300, 220, True)
+                if not ok:
+                    self.statusBar().showMessage("Save cancelled" ,3000)
+                    return
+                self.save_options[format] = options
+
+            self.save_path = (file_path, path[1])
+            document = self.document
+
+            def commit(patched):
+                note("size", document.image.size)
+                if patched:
+                    self.statusBar().showMessage("Saved by updating the EXIF orientation, no re-encoding" ,3000)
+                else:
+                    self.statusBar().showMessage("Saved %s" % os.path.basename(file_path) ,3000)
+
+            # Large images take seconds to encode; the window stays usable meanwhile.
+            self.jobs.run("Saving", lambda progress: document.save(file_path, lossless, options, progress), commit)
+
+    def exportRecipe(self):
+        if not self.document.hasImage():
+            self.statusBar().showMessage("No image currently open!" ,3000)
+            return
 
+        path = QFileDialog.getSaveFileName(self, "Export Recipe", self.default_path, "Recipe Files (*.json)")
         if path[0] == "":
             self.statusBar().showMessage("File dialog closed" ,3000)
         else:
-            self.save_path = path
-            shutil.copy(self.cache_path, self.save_path[0])
+            saveRecipe(path[0], self.document.state())
+            self.statusBar().showMessage("Recipe exported" ,3000)
+
+    def importRecipe(self):
+        if not self.viewer.hasPhoto():
+            self.statusBar().showMessage("No image currently open!" ,3000)
+            return
+
+        path = QFileDialog.getOpenFileName(self, "Apply Recipe", self.default_path, "Recipe Files (*.json)")
+        if path[0] == "":
+            self.statusBar().showMessage("File dialog closed" ,3000)
+            return
+
+        try:
+            steps = loadRecipe(path[0])
+        except (OSError, ValueError, KeyError, TypeError) as error:
+            self.statusBar().showMessage("Could not read the recipe: %s" % error, 5000)
+        else:
+            self.applyRecipe("Recipe", self.document.state() + steps, "Recipe successfully applied")
+
+    def setLosslessRotation(self, checked):
+        self.lossless_rotation = checked
 
     def imageGray(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            output = img.convert('L')
-            output.save(self.cache_path)
-            
-            self.statusBar().showMessage("Image adjustment successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+            self.applyOperation("Grayscale", Step("gray"),
+                                "Image adjustment successfully applied")
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def imageInvert(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            output = ImageOps.invert(img)
-            output.save(self.cache_path)
-            
-            self.statusBar().showMessage("Image adjustment successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+            # Inverting undoes itself on 8-bit images; deeper ones are reduced to 8 bits first.
+            exact = self.document.image.mode in POINT_MODES
+            self.applyOperation("Invert", Step("invert"),
+                                "Image adjustment successfully applied",
+                                (lambda: self.addOperation(invertImage, invertImage)) if exact else None)
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def imageContrast(self):
-            img = Image.open(self.cache_path)
-            enhancer = ImageEnhance.Contrast(img)
-            output = enhancer.enhance(self.img_contrast)
-            output.save(self.cache_path)
-
-            self.statusBar().showMessage("Image contrast changed" ,3000)
-            self.addCommand()
-            self.setImage()
+            contrast = self.img_contrast
+            self.applyOperation("Contrast", Step("contrast", factor=contrast),
+                                "Image contrast changed")
 
     def imageBrightness(self):
-            img = Image.open(self.cache_path)
-            enhancer = ImageEnhance.Brightness(img)
-            output = enhancer.enhance(self.img_brightness)
+            brightness = self.img_brightness
+            self.applyOperation("Brightness", Step("brightness", factor=brightness),
+                                "Image brightness changed")
 
-            output.save(self.cache_path)
+    def imageGamma(self):
+            gamma = self.gamma
+            self.applyOperation("Gamma", Step("gamma", gamma=gamma),
+                                "Image gamma changed")
 
-            self.statusBar().showMessage("Image brightness changed" ,3000)
-            self.addCommand()
-            self.setImage()
-            
     def drawImage(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            img_grey = img.convert('L')
-            img_blur = img_grey.filter(ImageFilter.GaussianBlur(radius = 2.5))
-            image = ImageMath.eval("convert(a * 256/b, 'L')", a=img_grey, b=img_blur)
-
-            image.save(self.cache_path)
-
-            self.statusBar().showMessage("Image filter successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+            self.applyOperation("Picture Drawing", Step("sketch", radius=SKETCH_RADIUS),
+                                "Image filter successfully applied")
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def removeBackground(self):
         if self.viewer.hasPhoto():
-            input = Image.open(self.cache_path)
-            output = remove(input)
-            output.save(self.cache_path)
-
-            if self.rem_index == 1:
-                height, width = input.size
-                white = Image.new("RGB", (height, width), (255, 255, 255))
-
-                white.paste(output, (0,0), mask = output)
-                white.save(self.cache_path)
-                
-            elif self.rem_index == 2:
-                height, width = input.size
-                white = Image.new("RGB", (height, width), (0, 0, 0))
-
-                white.paste(output, (0,0), mask = output)
-                white.save(self.cache_path)
-
-            self.statusBar().showMessage("Image filter successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+            index = self.rem_index
+            self.applyOperation("Background Removal", Step("rembg", background=index),
+                                "Image filter successfully applied")
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
+    def startPreview(self, render):
+        # Previews are rendered on a copy no larger than the screen and shown in place of
+        # the full resolution image until the real operation replaces it.
+        screen = self.screen().size() * self.screen().devicePixelRatio()
+        image, scale = fitImage(self.document.image, screen.width(), screen.height())
+
+        self.preview = PreviewScheduler(lambda value: imageToQImage(render(image, value)), parent=self)
+        self.preview.ready.connect(self.viewer.setPreview)
+        return self.preview.request
+
+    def stopPreview(self, keep=False):
+        # The scheduler holds its own thread pool and the proxy image; both go with the dialog.
+        self.preview.stop()
+        self.preview.deleteLater()
+        self.preview = None
+        if not keep:
+            self.viewer.clearPreview()
+
     def contrastDialog(self):
-        if self.viewer.hasPhoto():
+        if self.viewer.hasPhoto() and not self.isBusy():
+            preview = self.startPreview(lambda img, value: contrastImage(img, value/50))
             contrast = ApplicationDialogs()
-            i, ok = contrast.sliderDialog(50, 0, 100, "Set Contrast", 300, 120, True)
+            i, ok = contrast.sliderDialog(50, 0, 100, "Set Contrast", 300, 120, True, preview)
+            self.stopPreview(keep=ok)
 
             if ok:
                 self.img_contrast = i/50
@@ -357,9 +610,11 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def brightnessDialog(self):
-        if self.viewer.hasPhoto():
+        if self.viewer.hasPhoto() and not self.isBusy():
+            preview = self.startPreview(lambda img, value: brightnessImage(img, value/50))
             brightness = ApplicationDialogs()
-            i, ok = brightness.sliderDialog(50, 0, 100, "Set Brightness", 300, 120, True)
+            i, ok = brightness.sliderDialog(50, 0, 100, "Set Brightness", 300, 120, True, preview)
+            self.stopPreview(keep=ok)
 
             if ok:
                 self.img_brightness = i/50
@@ -368,6 +623,20 @@ class MainWindow(QMainWindow):
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
+    def gammaDialog(self):
+        if self.viewer.hasPhoto() and not self.isBusy():
+            preview = self.startPreview(lambda img, value: gammaImage(img, value/100))
+            gamma = ApplicationDialogs()
+            i, ok = gamma.sliderDialog(100, 10, 300, "Set Gamma", 300, 120, True, preview)
+            self.stopPreview(keep=ok)
+
+            if ok:
+                self.gamma = i/100
+                self.imageGamma()
+
+        else:
+            self.statusBar().showMessage("No image currently open!" ,3000)
+
     def rem_bgDialog(self):
         if self.viewer.hasPhoto():
             rem_bg = ApplicationDialogs()
@@ -382,14 +651,24 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def cropDialog(self):
-        if self.viewer.hasPhoto():
+        if self.viewer.hasPhoto() and not self.isBusy():
             crop_widget = CropWidget()
-            cropped = crop_widget.callCropDialog("Crop Image", 900, 600, True)
+            box = crop_widget.callCropDialog(self.document.image, "Crop Image", 900, 600, True)
+
+            if box:
+                self.applyOperation("Crop", Step("crop", box=box),
+                                    "Image successfully cropped")
+
+        else:
+            self.statusBar().showMessage("No image currently open!" ,3000)
 
-            if cropped:
-                self.statusBar().showMessage("Image successfully cropped" ,3000)
-                self.addCommand()
-                self.setImage()
+    def recipeDialog(self):
+        if self.viewer.hasPhoto() and not self.isBusy():
+            recipe_widget = ApplicationDialogs()
+            steps, ok = recipe_widget.recipeDialog(self.document.state(), "Recipe", 420, 360, True)
+
+            if ok and steps != self.document.state():
+                self.applyRecipe("Recipe", steps, "Recipe successfully applied")
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
@@ -404,56 +683,45 @@ class MainWindow(QMainWindow):
 
     def rotateClockwise(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            rotated_img = img.rotate(-90)
-
-            rotated_img.save(self.cache_path)
-
-            self.statusBar().showMessage("Image rotation successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+            self.applyOperation("Rotation", Step("transpose", method=Image.ROTATE_270),
+                                "Image rotation successfully applied",
+                                lambda: self.addTransform(Image.ROTATE_270))
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def rotateAnticlockwise(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            rotated_img = img.rotate(90)
+            self.applyOperation("Rotation", Step("transpose", method=Image.ROTATE_90),
+                                "Image rotation successfully applied",
+                                lambda: self.addTransform(Image.ROTATE_90))
 
-            rotated_img.save(self.cache_path)
+        else:
+            self.statusBar().showMessage("No image currently open!" ,3000)
 
-            self.statusBar().showMessage("Image rotation successfully applied" ,3000)
-            self.addCommand()
-            self.setImage()
+    def rotateHalf(self):
+        if self.viewer.hasPhoto():
+            self.applyOperation("Rotation", Step("transpose", method=Image.ROTATE_180),
+                                "Image rotation successfully applied",
+                                lambda: self.addTransform(Image.ROTATE_180))
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def flipHorizontal(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            flipped_img = img.transpose(Image.FLIP_LEFT_RIGHT)
-
-            flipped_img.save(self.cache_path)
-
-            self.statusBar().showMessage("Image successfully flipped" ,3000)
-            self.addCommand()
-            self.setImage()
+            self.applyOperation("Flip", Step("transpose", method=Image.FLIP_LEFT_RIGHT),
+                                "Image successfully flipped",
+                                lambda: self.addTransform(Image.FLIP_LEFT_RIGHT))
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
 
     def flipVertical(self):
         if self.viewer.hasPhoto():
-            img = Image.open(self.cache_path)
-            flipped_img = img.transpose(Image.FLIP_TOP_BOTTOM)
-
-            flipped_img.save(self.cache_path)
-
-            self.statusBar().showMessage("Image successfully flipped" ,3000)
-            self.addCommand()
-            self.setImage()
+            self.applyOperation("Flip", Step("transpose", method=Image.FLIP_TOP_BOTTOM),
+                                "Image successfully flipped",
+                                lambda: self.addTransform(Image.FLIP_TOP_BOTTOM))
 
         else:
             self.statusBar().showMessage("No image currently open!" ,3000)
@@ -462,25 +730,71 @@ class MainWindow(QMainWindow):
         self.editMode = True
 
     def setImage(self):
-        im_file = BytesIO(self.uStack[-1])
-        img = Image.open(im_file)
-        img.save(self.cache_path)
-        self.viewer.setPhoto(QPixmap(self.cache_path))
+        if self.document.hasImage():
+            note("size", self.document.image.size)
+            with phase("display"):
+                self.viewer.setPhoto(self.document.image, self.history.changed)
+
+    def showTimings(self, trace):
+        phases = "  ".join("%s %.2f" % (name, duration) for name, duration in trace.summary())
+        text = "%s %.2f s  (%s)" % (trace.name, trace.duration(), phases)
+        size = trace.info.get("size")
+        if size:
+            text += "  %.1f MP" % (size[0] * size[1] / 1e6)
+        if trace.peak_memory:
+            text += "  peak %d MB" % (trace.peak_memory / 2**20)
+        if trace.status != "done":
+            text += "  " + trace.status
+        self.hud_label.setText(text)
+
+    def exportTimings(self):
+        path = QFileDialog.getSaveFileName(self, "Export Timings", self.default_path, "JSON Lines (*.jsonl);; Chrome Trace (*.json)")
+        if path[0] == "":
+            self.statusBar().showMessage("File dialog closed" ,3000)
+            return
+
+        file_path = path[0]
+        if not os.path.splitext(file_path)[1]:
+            file_path += filterExtension(path[1]) or ".jsonl"
+        if file_path.lower().endswith(".json"):
+            self.instrumentation.exportChromeTrace(file_path)
+        else:
+            self.instrumentation.exportJsonLines(file_path)
+        self.statusBar().showMessage("Timings of %d operations exported" % len(self.instrumentation.records) ,3000)
 
     def quitApp(self):
         self.app.quit()
 
+    def resultCache(self):
+        # Sketches and background removals are kept on disk between sessions (ARTMACHINE_CACHE_DIR,
+        # ARTMACHINE_CACHE_MB); 0 MB, or a directory that cannot be made, turns that off.
+        budget = int(os.environ.get("ARTMACHINE_CACHE_MB", 1024)) * 2**20
+        if budget <= 0:
+            return None
+        try:
+            return ResultCache(budget=budget)
+        except OSError:
+            return None
+
     def closeEvent(self, event):
-        if os.path.exists(self.cache_path):
-            os.remove(self.cache_path)
+        if self.jobs.name() == "Saving":
+            # The file only exists once the save is done; closing waits for it instead.
+            self.statusBar().showMessage("Finishing saving %s..." % os.path.basename(self.save_path[0]))
+            loop = QEventLoop()
+            self.jobs.stopped.connect(loop.quit)
+            loop.exec()
+        self.jobs.cancel()
+        if self.profiler is not None:
+            self.profiler.end()
+        self.history.close()
 
 class ApplicationDialogs(QDialog):
     def __init__(self):
         super().__init__()
         self.setStyleSheet("QDialog {background: rgb(25, 25, 25);}")
 
-    def sliderDialog(self, initialValue, minimumValue, maximumValue, windowTitle, windowWidth, windowHeight, modal):
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
+    def sliderDialog(self, initialValue, minimumValue, maximumValue, windowTitle, windowWidth, windowHeight, modal, preview=None):
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
         self.setWindowTitle(windowTitle)
         self.setGeometry(700, 300, windowWidth, windowHeight)
         self.setFixedSize(QSize(windowWidth, windowHeight))
@@ -497,6 +811,8 @@ class ApplicationDialogs(QDialog):
         self.slider.setMaximum(maximumValue)
         self.slider.setValue(initialValue)
         self.slider.valueChanged.connect(self.changeValue)
+        if preview is not None:
+            self.slider.valueChanged.connect(preview)
 
         self.line.setMaximumWidth(40)
         self.line.setAlignment(Qt.AlignCenter)
@@ -586,7 +902,7 @@ class ApplicationDialogs(QDialog):
         self.accept()
 
     def radioDialog(self, caption, count, buttonNames, windowTitle, windowWidth, windowHeight, modal):
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
         self.setWindowTitle(windowTitle)
         self.setGeometry(700, 300, windowWidth, windowHeight)
         self.setFixedSize(QSize(windowWidth, windowHeight))
@@ -675,8 +991,238 @@ class ApplicationDialogs(QDialog):
 
         self.accept()
 
+    def recipeDialog(self, steps, windowTitle, windowWidth, windowHeight, modal):
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
+        self.setWindowTitle(windowTitle)
+        self.setGeometry(700, 300, windowWidth, windowHeight)
+        self.setFixedSize(QSize(windowWidth, windowHeight))
+        self.setModal(modal)
+        self.setStyleSheet(
+                            """
+                            QDialog {background: rgb(25, 25, 25);}
+
+                            QListWidget, QDoubleSpinBox, QSpinBox, QComboBox {
+                                background-color: #404040;
+                                border: none;
+                                color: #CCCCCC;
+                            }
+
+                            QLabel {color: #CCCCCC;}
+
+                            QPushButton {
+                                background-color: #222222;
+                                border: 2px solid #555555;
+                                border-radius: 5px;
+                                color: #CCCCCC;
+                                padding: 8px 8px;
+                            }
+
+                            QPushButton:hover {
+                                background-color: #333333;
+                            }
+
+                            QPushButton:pressed {
+                                background-color: #444444;
+                                border: 2px solid #777777;
+                            }
+                            """
+                        )
+
+        self.steps = list(steps)
+        self.parameter_widgets = {}
+
+        self.step_list = QListWidget()
+        self.step_list.currentRowChanged.connect(self.showStep)
+        self.parameter_layout = QFormLayout()
+
+        update_button = QPushButton("Update Step")
+        update_button.clicked.connect(self.updateStep)
+        remove_button = QPushButton("Remove Step")
+        remove_button.clicked.connect(self.removeStep)
+        self.ok_button = QPushButton("Ok")
+        self.ok_button.clicked.connect(self.setRecipe)
+
+        layout = QVBoxLayout()
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(update_button)
+        button_layout.addWidget(remove_button)
+        button_layout.addWidget(self.ok_button)
+
+        layout.addWidget(self.step_list)
+        layout.addLayout(self.parameter_layout)
+        layout.addSpacing(5)
+        layout.addLayout(button_layout)
+
+        self.setLayout(layout)
+        self.refreshSteps(len(self.steps) - 1)
+
+        self.return_value = False
+
+        self.show()
+        self.exec()
+
+        if self.return_value:
+            return tuple(self.steps), True
+        else:
+            return tuple(steps), False
+
+    def refreshSteps(self, row):
+        self.step_list.clear()
+        self.step_list.addItems([step.label() for step in self.steps])
+        self.step_list.setCurrentRow(min(row, len(self.steps) - 1))
+
+    def showStep(self, row):
+        while self.parameter_layout.rowCount():
+            self.parameter_layout.removeRow(0)
+        self.parameter_widgets = {}
+        if row < 0:
+            return
+
+        step = self.steps[row]
+        for name, minimum, maximum, single_step in RECIPE_PARAMETERS.get(step.name, []):
+            widget = QDoubleSpinBox()
+            widget.setRange(minimum, maximum)
+            widget.setSingleStep(single_step)
+            widget.setValue(step.params[name])
+            self.parameter_widgets[name] = widget
+            self.parameter_layout.addRow(name.capitalize(), widget)
+
+        if step.name == "crop":
+            boxes = []
+            for label, value in zip(["Left", "Top", "Right", "Bottom"], step.params["box"]):
+                widget = QSpinBox()
+                widget.setRange(0, 1000000)
+                widget.setValue(int(value))
+                boxes.append(widget)
+                self.parameter_layout.addRow(label, widget)
+            self.parameter_widgets["box"] = boxes
+
+        elif step.name in ("transpose", "rembg"):
+            widget = QComboBox()
+            if step.name == "transpose":
+                for method, label in TRANSPOSE_NAMES.items():
+                    widget.addItem(label, method)
+                widget.setCurrentIndex(widget.findData(step.params["method"]))
+                self.parameter_widgets["method"] = widget
+            else:
+                widget.addItems(BACKGROUND_NAMES)
+                widget.setCurrentIndex(step.params.get("background", 0))
+                self.parameter_widgets["background"] = widget
+            self.parameter_layout.addRow("Value", widget)
+
+    def updateStep(self):
+        row = self.step_list.currentRow()
+        if row < 0:
+            return
+
+        params = {}
+        for name, widget in self.parameter_widgets.items():
+            if name == "box":
+                params[name] = tuple(box.value() for box in widget)
+            elif name == "method":
+                params[name] = widget.currentData()
+            elif name == "background":
+                params[name] = widget.currentIndex()
+            else:
+                params[name] = widget.value()
+        self.steps[row] = self.steps[row].replace(**params)
+        self.refreshSteps(row)
+
+    def removeStep(self):
+        row = self.step_list.currentRow()
+        if row >= 0:
+            del self.steps[row]
+            self.refreshSteps(row)
+
+    def setRecipe(self):
+        self.return_value = True
+        self.accept()
+
+    def saveDialog(self, format, options, windowTitle, windowWidth, windowHeight, modal):
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
+        self.setWindowTitle(windowTitle)
+        self.setGeometry(700, 300, windowWidth, windowHeight)
+        self.setFixedSize(QSize(windowWidth, windowHeight))
+        self.setModal(modal)
+        self.setStyleSheet(
+                            """
+                            QDialog {background: rgb(25, 25, 25);}
+
+                            QSpinBox, QComboBox {
+                                background-color: #404040;
+                                border: none;
+                                color: #CCCCCC;
+                            }
+
+                            QLabel, QCheckBox {color: #CCCCCC;}
+
+                            QPushButton {
+                                background-color: #222222;
+                                border: 2px solid #555555;
+                                border-radius: 5px;
+                                color: #CCCCCC;
+                                padding: 8px 8px;
+                            }
+
+                            QPushButton:hover {
+                                background-color: #333333;
+                            }
+
+                            QPushButton:pressed {
+                                background-color: #444444;
+                                border: 2px solid #777777;
+                            }
+                            """
+                        )
+
+        widgets = {}
+        form_layout = QFormLayout()
+        for name, label, kind in SAVE_PARAMETERS[format]:
+            if kind is bool:
+                widget = QCheckBox()
+                widget.setChecked(bool(options[name]))
+            elif isinstance(kind, list):
+                widget = QComboBox()
+                widget.addItems(kind)
+                widget.setCurrentIndex(max(0, widget.findText(str(options[name]))))
+            else:
+                widget = QSpinBox()
+                widget.setRange(*kind)
+                widget.setValue(int(options[name]))
+            widgets[name] = widget
+            form_layout.addRow(label, widget)
+
+        ok_button = QPushButton("Save")
+        ok_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+
+        layout = QVBoxLayout()
+        button_layout = QHBoxLayout()
+        button_layout.addWidget(ok_button)
+        button_layout.addWidget(cancel_button)
+
+        layout.addLayout(form_layout)
+        layout.addStretch()
+        layout.addLayout(button_layout)
+        self.setLayout(layout)
+
+        self.show()
+        if not self.exec():
+            return options, False
+
+        values = {}
+        for name, widget in widgets.items():
+            if isinstance(widget, QCheckBox):
+                values[name] = widget.isChecked()
+            elif isinstance(widget, QComboBox):
+                values[name] = widget.currentText()
+            else:
+                values[name] = widget.value()
+        return values, True
+
     def aboutDialog(self):
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
         self.setWindowTitle("About")
         self.setGeometry(700, 300, 550, 300)
         self.setStyleSheet("QDialog {background: rgb(25, 25, 25);}")
@@ -688,7 +1234,7 @@ class ApplicationDialogs(QDialog):
         link_layout = QHBoxLayout()
 
         image_label = QLabel()
-        pixmap = QPixmap("sprites\\Icon.png")
+        pixmap = QPixmap(":/sprites/Icon.png")
         pixmap = pixmap.scaledToWidth(128)
 
         image_label.setPixmap(pixmap)
@@ -795,7 +1341,7 @@ class ApplicationDialogs(QDialog):
         self.exec()
 
     def settingsDialog(self, openLocation, saveLocation):
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
         self.setWindowTitle("Settings")
         self.setGeometry(700, 300, 560, 200)
         self.setStyleSheet("QDialog {background: rgb(25, 25, 25);}")
@@ -811,7 +1357,7 @@ class ApplicationDialogs(QDialog):
         button_layout = QHBoxLayout()
 
         image_label = QLabel()
-        pixmap = QPixmap("sprites\\Settings.png")
+        pixmap = QPixmap(":/sprites/Settings.png")
         pixmap = pixmap.scaledToWidth(96)
 
         image_label.setPixmap(pixmap)
@@ -1025,15 +1571,23 @@ class ApplicationDialogs(QDialog):
 class Viewport(QGraphicsView):
     def __init__(self, parent):
         super(Viewport, self).__init__(parent)
-        pixmap = QPixmap("files\\Openning.png")
+        pixmap = QPixmap(":/files/Openning.png")
         pixmap = pixmap.scaled(pixmap.width()/1.6, pixmap.height()/1.6, Qt.KeepAspectRatio, Qt.SmoothTransformation)
 
         self._zoom = 0
         self._empty = True
+        self._draft = None
         self._scene = QGraphicsScene(self)
         self._photo = QGraphicsPixmapItem()
         self._photo.setPixmap(pixmap)
         self._scene.addItem(self._photo)
+        self._tiles = TiledImageItem()
+        self._tiles.hide()
+        self._scene.addItem(self._tiles)
+        self._preview = QGraphicsPixmapItem()
+        self._preview.setTransformationMode(Qt.SmoothTransformation)
+        self._preview.hide()
+        self._scene.addItem(self._preview)
 
         self.setScene(self._scene)
         self.setTransformationAnchor(QGraphicsView.AnchorUnderMouse)
@@ -1047,8 +1601,13 @@ class Viewport(QGraphicsView):
     def hasPhoto(self):
         return not self._empty
 
+    def photoRect(self):
+        if self.hasPhoto():
+            return self._tiles.mapRectToScene(self._tiles.boundingRect())
+        return QRectF(self._photo.pixmap().rect())
+
     def fitInView(self, scale=True):
-        rect = QRectF(self._photo.pixmap().rect())
+        rect = self.photoRect()
         if not rect.isNull():
             self.setSceneRect(rect)
             if self.hasPhoto():
@@ -1061,18 +1620,47 @@ class Viewport(QGraphicsView):
                 self.scale(factor, factor)
             self._zoom = 0
 
-    def setPhoto(self, pixmap=None):
-        self._zoom = 0
-        if pixmap and not pixmap.isNull():
+    def setPreview(self, image):
+        # The preview is usually smaller than the photo; scale it up to cover the same area.
+        pixmap = QPixmap.fromImage(image)
+        self._preview.setPixmap(pixmap)
+        self._preview.setScale(self.photoRect().width() / max(pixmap.width(), 1))
+        self._preview.show()
+        self._tiles.hide()
+
+    def clearPreview(self):
+        self._preview.hide()
+        self._preview.setPixmap(QPixmap())
+        if self.hasPhoto():
+            self._tiles.show()
+
+    def setPhoto(self, image=None, dirty=None, size=None):
+        # Takes the PIL image itself; it is cut into tiles and a pyramid in the background.
+        # Only tiles inside the `dirty` boxes are made again when it replaces a same sized one.
+        # A reduced draft is given the `size` of the full image, which later takes its place
+        # without moving the view.
+        keep = self._draft is not None and image is not None and size is None and image.size == self._draft
+        self._draft = size if image is not None else None
+
+        self.clearPreview()
+        self._photo.setPixmap(QPixmap())
+        self._tiles.setImage(image, dirty)
+        if image is not None and size is not None:
+            self._tiles.setTransform(QTransform.fromScale(size[0] / image.width, size[1] / image.height))
+        else:
+            self._tiles.resetTransform()
+        if image is not None:
             self._empty = False
             self.setDragMode(QGraphicsView.ScrollHandDrag)
-            self._photo.setPixmap(pixmap)
+            self._tiles.show()
             self._size = self.size() 
         else:
             self._empty = True
             self.setDragMode(QGraphicsView.NoDrag)
-            self._photo.setPixmap(QPixmap())
-        self.fitInView()
+            self._tiles.hide()
+        if not keep:
+            self._zoom = 0
+            self.fitInView()
 
     def wheelEvent(self, event):
         if self.hasPhoto():
@@ -1098,10 +1686,12 @@ class Viewport(QGraphicsView):
 
     def zoomCheck(self):
         if self._zoom > 0:
-            if self._zoom < 20:
+            # Zooming in stops at 32 screen pixels per image pixel rather than after a fixed
+            # number of steps, so huge images can still be zoomed down to single pixels.
+            if self.transform().m11() * self.zoomFactor <= 32:
                 self.scale(self.zoomFactor, self.zoomFactor)
             else:
-                self._zoom = 20
+                self._zoom -= 1
         elif self._zoom == 0:
             self.fitInView()
         else:
@@ -1113,7 +1703,7 @@ class Viewport(QGraphicsView):
     def toggleDragMode(self):
         if self.dragMode() == QGraphicsView.ScrollHandDrag:
             self.setDragMode(QGraphicsView.NoDrag)
-        elif not self._photo.pixmap().isNull():
+        elif self.hasPhoto():
             self.setDragMode(QGraphicsView.ScrollHandDrag)
 
     def mousePressEvent(self, event: QMouseEvent):
@@ -1152,11 +1742,19 @@ class CropView(QGraphicsView):
         self.setScene(self.scene)
         self.setBackgroundBrush(QBrush(QColor(30, 30, 30)))
 
-        self.pixmap_item = QGraphicsPixmapItem()
-        self.scene.addItem(self.pixmap_item)
+        # The photo is a screen sized proxy; cropping only narrows the clip around it, so the
+        # scene is never rebuilt and the crop stays in proxy coordinates until it is saved.
+        self.clip_item = QGraphicsRectItem()
+        self.clip_item.setPen(QPen(Qt.NoPen))
+        self.clip_item.setFlag(QGraphicsRectItem.ItemClipsChildrenToShape)
+        self.pixmap_item = QGraphicsPixmapItem(self.clip_item)
+        self.scene.addItem(self.clip_item)
+
+        self.image_size = (0, 0)
+        self.image_scale = (1.0, 1.0)
 
 
-    def setPhoto(self, pixmap=None):
+    def setPhoto(self, pixmap=None, image_size=None, image_scale=(1.0, 1.0)):
         if pixmap and not pixmap.isNull():
             self._empty = False
             self.setDragMode(QGraphicsView.ScrollHandDrag)
@@ -1166,10 +1764,13 @@ class CropView(QGraphicsView):
             self._empty = True
             self.setDragMode(QGraphicsView.NoDrag)
             self.pixmap_item.setPixmap(QPixmap())
+        self.clip_item.setRect(QRectF(self.pixmap_item.pixmap().rect()))
+        self.image_size = image_size or (self.pixmap_item.pixmap().width(), self.pixmap_item.pixmap().height())
+        self.image_scale = image_scale
         self.fitInView()
 
     def fitInView(self, scale=True):
-        rect = QRectF(self.pixmap_item.pixmap().rect())
+        rect = self.clip_item.rect()
         if not rect.isNull():
             self.setSceneRect(rect)
 
@@ -1215,31 +1816,33 @@ class CropView(QGraphicsView):
             self.parent().reset_button.setEnabled(True)
 
     def cropImage(self):
-        rect = self.rect_item.rect().toRect()
-        cropped_pixmap = self.pixmap_item.pixmap().copy(rect)
-        self.scene.clear()
-        self.pixmap_item = QGraphicsPixmapItem(cropped_pixmap)
-        self.scene.addItem(self.pixmap_item)
-        self.setSceneRect(QRectF(cropped_pixmap.rect()))
-        self.rect_item = None
-
-        self.parent().crop_button.setEnabled(False)
-        self.parent().reset_button.setEnabled(False)
+        rect = self.rect_item.rect().intersected(self.clip_item.rect())
+        if not rect.isEmpty():
+            self.clip_item.setRect(rect)
+            self.fitInView()
+        self.cropReset()
 
     def cropReset(self):
-        pixmap = self.pixmap_item.pixmap()
-        self.scene.clear()
-        self.pixmap_item = QGraphicsPixmapItem(pixmap)
-        self.scene.addItem(self.pixmap_item)
-        self.setSceneRect(QRectF(pixmap.rect()))
-        self.rect_item = None
+        if self.rect_item is not None:
+            self.scene.removeItem(self.rect_item)
+            self.rect_item = None
 
         self.parent().crop_button.setEnabled(False)
         self.parent().reset_button.setEnabled(False)
 
     def saveCrop(self):
-        pixmap = self.pixmap_item.pixmap()
-        pixmap.save("files\\data.png")
+        # The crop in full resolution image coordinates, or None if nothing was cut away.
+        rect = self.clip_item.rect()
+        if rect == QRectF(self.pixmap_item.pixmap().rect()):
+            return None
+
+        scale_x, scale_y = self.image_scale
+        width, height = self.image_size
+        left = min(max(int(math.floor(rect.left() * scale_x)), 0), width - 1)
+        top = min(max(int(math.floor(rect.top() * scale_y)), 0), height - 1)
+        right = min(max(int(math.ceil(rect.right() * scale_x)), left + 1), width)
+        bottom = min(max(int(math.ceil(rect.bottom() * scale_y)), top + 1), height)
+        return (left, top, right, bottom)
 
 class CropWidget(QDialog):
     def __init__(self):
@@ -1381,23 +1984,26 @@ class CropWidget(QDialog):
 
         self.setLayout(hlayout)
 
-    def callCropDialog(self, windowTitle, windowWidth, windowHeight, modal):
-        self.setWindowIcon(QIcon("sprites\\Icon.png"))
+    def callCropDialog(self, image, windowTitle, windowWidth, windowHeight, modal):
+        self.setWindowIcon(QIcon(":/sprites/Icon.png"))
         self.setWindowTitle(windowTitle)
         self.setGeometry(700, 300, windowWidth, windowHeight)
         self.setFixedSize(QSize(windowWidth, windowHeight))
         self.setModal(modal)
 
         self.return_value = False
+        self.crop_box = None
 
         self.show()
-        self.crop_view.setPhoto(QPixmap("files\\data.png"))
+        ratio = self.devicePixelRatio()
+        proxy, scale = fitImage(image, self.crop_view.width() * ratio, self.crop_view.height() * ratio)
+        self.crop_view.setPhoto(QPixmap.fromImage(imageToQImage(proxy)), image.size, scale)
         self.exec()
 
         if self.return_value:
-            return True
+            return self.crop_box
         else:
-            return False
+            return None
 
     def applyCrop(self):
         self.crop_view.cropImage()
@@ -1407,14 +2013,23 @@ class CropWidget(QDialog):
         self.crop_view.cropReset()
 
     def acceptCrop(self):
-        self.crop_view.saveCrop()
+        self.crop_box = self.crop_view.saveCrop()
         self.accept()
 
     def rejectCrop(self):
         self.return_value = False
         self.reject()
 
-app = QApplication(sys.argv)
-window = MainWindow(app)
-window.show()
-app.exec()
\ No newline at end of file
+if __name__ == "__main__":
+    if "--profile" in sys.argv:
+        index = sys.argv.index("--profile")
+        directory = "profiles"
+        if index + 1 < len(sys.argv) and not sys.argv[index + 1].startswith("-"):
+            directory = sys.argv.pop(index + 1)
+        sys.argv.pop(index)
+        os.environ["ARTMACHINE_PROFILE"] = directory
+
+    app = QApplication(sys.argv)
+    window = MainWindow(app)
+    window.show()
+    app.exec()
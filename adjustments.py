@@ -0,0 +1,178 @@
+from functools import partial
+
+import numpy as np
+
+from tiling import TILE_SIZE, processTiled, tileBoxes
+
+
+POINT_MODES = ("L", "RGB", "RGBA")
+HIGH_BIT_MODES = ("I;16", "I", "F")
+
+IDENTITY = np.arange(256, dtype=np.uint8)
+
+
+def blendTable(base, factor):
+    # Image.blend(base, img, factor) per pixel value: computed in single precision, clipped and
+    # truncated the way Pillow does it, so a table built here matches ImageEnhance exactly.
+    values = np.float32(base) + np.float32(factor) * (IDENTITY.astype(np.float32) - np.float32(base))
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+def invertTable():
+    return IDENTITY[::-1].copy()
+
+
+def gammaTable(gamma):
+    return np.rint(255 * (IDENTITY / 255) ** (1 / gamma)).astype(np.uint8)
+
+
+def eightBitImage(img):
+    # 16 and 32-bit integer images keep their top 8 bits, the way they are shown on screen.
+    if img.mode in POINT_MODES:
+        return img
+    if img.mode in ("I;16", "I"):
+        img = img.convert("I").point(lambda value: value / 256)
+    return img.convert("L")
+
+
+def applyStages(img, stages):
+    for stage, value in stages:
+        if stage == "gray":
+            img = img.convert("L")
+        elif stage == "eightbit":
+            img = eightBitImage(img)
+        else:
+            img = img.point(value)
+    return img
+
+
+def lumaHistogram(img, stages, tile_size=TILE_SIZE):
+    # Read only pass: what convert("L").histogram() would give after `stages`, a tile at a time.
+    histogram = np.zeros(256, np.int64)
+    for box in tileBoxes(img.size, tile_size):
+        tile = applyStages(img.crop(box), stages)
+        if tile.mode != "L":
+            tile = tile.convert("L")
+        histogram += tile.histogram()
+    return histogram
+
+
+def histogramMean(histogram):
+    return int(np.dot(histogram, np.arange(256)) / histogram.sum() + 0.5)
+
+
+class PointPipeline:
+    # A chain of point adjustments (grayscale, invert, contrast, brightness, gamma) folded into
+    # one lookup table per channel, so the whole chain is a single pass over the pixels however
+    # many steps it has. Alpha is never touched. Grayscale changes the number of channels, so
+    # it splits the chain, but both halves still run on the same tile while it is in cache.
+    # High bit depth images are brought down to 8-bit grey first, a tile at a time.
+    def __init__(self, steps=()):
+        self.steps = list(steps)
+
+    def __len__(self):
+        return len(self.steps)
+
+    def gray(self):
+        self.steps.append(("gray", None))
+        return self
+
+    def invert(self):
+        self.steps.append(("invert", None))
+        return self
+
+    def contrast(self, factor):
+        self.steps.append(("contrast", factor))
+        return self
+
+    def brightness(self, factor):
+        self.steps.append(("brightness", factor))
+        return self
+
+    def gamma(self, gamma):
+        if gamma <= 0:
+            raise ValueError("gamma must be positive")
+        self.steps.append(("gamma", gamma))
+        return self
+
+    def stages(self, img):
+        stages = []
+        mode = img.mode
+        if mode in HIGH_BIT_MODES:
+            stages.append(("eightbit", None))
+            mode = "L"
+        elif mode not in POINT_MODES:
+            raise ValueError("adjustments need an L, RGB, RGBA or high bit depth image, not %s" % img.mode)
+
+        table = IDENTITY
+        # Exact luminance histogram of the image after everything so far, when it is known
+        # without looking at the pixels again; None otherwise.
+        luma = None
+
+        for step, value in self.steps:
+            if step == "gray":
+                if mode != "L":
+                    if table is not IDENTITY:
+                        stages.append(("point", self.lut(mode, table)))
+                    stages.append(("gray", None))
+                    mode = "L"
+                    table = IDENTITY
+                continue
+
+            if step == "invert":
+                step_table = invertTable()
+            elif step == "contrast":
+                if luma is None:
+                    # The mean of an RGB image after per-channel tables cannot be read off the
+                    # channel histograms, so it is gathered from the tiles as they would be.
+                    prefix = stages + ([("point", self.lut(mode, table))] if table is not IDENTITY else [])
+                    luma = lumaHistogram(img, prefix)
+                step_table = blendTable(histogramMean(luma), value)
+            elif step == "brightness":
+                step_table = blendTable(0, value)
+            elif step == "gamma":
+                step_table = gammaTable(value)
+            else:
+                raise ValueError("unknown adjustment: %s" % step)
+
+            table = step_table[table]
+            if mode == "L" and luma is not None:
+                luma = np.bincount(step_table, weights=luma, minlength=256).astype(np.int64)
+            else:
+                luma = None
+
+        if table is not IDENTITY:
+            stages.append(("point", self.lut(mode, table)))
+        return stages
+
+    def lut(self, mode, table):
+        tables = [table.tolist()] * 3 if mode != "L" else [table.tolist()]
+        if mode == "RGBA":
+            tables.append(IDENTITY.tolist())
+        return sum(tables, [])
+
+    def apply(self, img, **options):
+        stages = self.stages(img)
+        if not stages:
+            return img.copy()
+        return processTiled(img, partial(applyStages, stages=stages), **options)
+
+
+def grayImage(img, **options):
+    return PointPipeline().gray().apply(img, **options)
+
+
+def invertImage(img, **options):
+    return PointPipeline().invert().apply(img, **options)
+
+
+def contrastImage(img, factor, **options):
+    return PointPipeline().contrast(factor).apply(img, **options)
+
+
+def brightnessImage(img, factor, **options):
+    return PointPipeline().brightness(factor).apply(img, **options)
+
+
+def gammaImage(img, gamma, **options):
+    return PointPipeline().gamma(gamma).apply(img, **options)
@@ -0,0 +1,163 @@
+import argparse
+import glob
+import os
+import sys
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image
+
+from document import decodeImage, encodableImage
+from filters import SKETCH_RADIUS
+from recipe import BACKGROUND_NAMES, Recipe, Step, loadRecipe
+from resultcache import ResultCache, defaultDirectory
+
+
+recipe = None
+
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff", ".webp")
+
+
+def collectInputs(patterns, recursive):
+    inputs = {}
+
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            if recursive:
+                paths = glob.glob(os.path.join(pattern, "**", "*"), recursive=True)
+            else:
+                paths = glob.glob(os.path.join(pattern, "*"))
+            root = pattern
+        else:
+            paths = glob.glob(pattern, recursive=recursive)
+            root = None
+
+        for path in paths:
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                name = os.path.relpath(path, root) if root else os.path.basename(path)
+                inputs.setdefault(os.path.abspath(path), name)
+
+    return sorted(inputs.items())
+
+
+def outputPath(name, output_dir, extension):
+    base = os.path.splitext(name)[0]
+    return os.path.join(output_dir, base + extension)
+
+
+def startWorker(model_name, threads, proxy_size, cache_dir, cache_budget):
+    # Each worker process builds one rembg session and keeps it for every image it handles.
+    # One image per process already fills every core; tiling inside a step only bounds memory.
+    # The result cache is shared with the GUI and the other workers through the directory.
+    global recipe
+    remover = None
+    if model_name:
+        from segmentation import BackgroundRemover
+        remover = BackgroundRemover(model_name, threads, proxy_size=proxy_size)
+    results = ResultCache(cache_dir, cache_budget) if cache_budget > 0 else None
+    recipe = Recipe(cache_budget=0, remover=remover, workers=1, results=results)
+
+
+def processFile(source, destination, steps):
+    # Upright like in the GUI, so crop boxes in recipes exported from it land in the same place.
+    recipe.reset(decodeImage(source)[0])
+    # Crops are moved ahead of the filters, so only pixels that survive are processed.
+    output = recipe.render(steps)
+
+    # Write next to the target and rename, so an interrupted run never leaves a half written
+    # file that a resumed run would mistake for a finished one.
+    os.makedirs(os.path.dirname(destination) or ".", exist_ok=True)
+    extension = os.path.splitext(destination)[1].lower()
+    partial = destination + ".part"
+    # Converted like the GUI saves, e.g. a transparent cutout is put on white for JPEG.
+    format = Image.registered_extensions()[extension]
+    encodableImage(output, format).save(partial, format=format)
+    os.replace(partial, destination)
+
+    # Worker processes exit without waiting for background threads.
+    if recipe.results is not None:
+        recipe.results.flush()
+    return output.width * output.height
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the Artmachine pencil sketch filter, or a recipe exported "
+                                                 "from the GUI, to many images.")
+    parser.add_argument("inputs", nargs="+", help="input directories, files or glob patterns")
+    parser.add_argument("-o", "--output", required=True, help="output directory")
+    parser.add_argument("-r", "--radius", type=float, default=SKETCH_RADIUS, help="blur radius of the sketch filter")
+    parser.add_argument("-f", "--format", default="png", help="output file extension (png, jpg, webp, ...)")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--recursive", action="store_true", help="descend into sub-directories")
+    parser.add_argument("--overwrite", action="store_true", help="redo images whose output already exists")
+    parser.add_argument("--remove-background", choices=["transparent", "white", "black"],
+                        help="remove the background with rembg before sketching")
+    parser.add_argument("--recipe", help="apply the steps of this recipe (File > Export Recipe) instead of the sketch filter")
+    parser.add_argument("--rembg-model", default="u2net", help="rembg model (u2net, u2netp, isnet-general-use, ...)")
+    parser.add_argument("--rembg-threads", type=int, default=1, help="onnxruntime threads per worker process")
+    parser.add_argument("--rembg-proxy", type=int, default=0,
+                        help="segment a copy this many pixels on its longest side and refine the mask (0 = off)")
+    parser.add_argument("--cache", default=defaultDirectory(),
+                        help="directory of sketch and background removal results reused across runs and the GUI")
+    parser.add_argument("--cache-mb", type=int, default=1024, help="size limit of the result cache (0 = off)")
+    args = parser.parse_args(argv)
+
+    if args.recipe:
+        steps = loadRecipe(args.recipe)
+    else:
+        steps = (Step("sketch", radius=args.radius),)
+        if args.remove_background:
+            background = [name.lower() for name in BACKGROUND_NAMES].index(args.remove_background)
+            steps = (Step("rembg", background=background),) + steps
+
+    model_name = args.rembg_model if any(step.name == "rembg" for step in steps) else None
+
+    extension = "." + args.format.lower().lstrip(".")
+    if extension not in Image.registered_extensions():
+        parser.error("unsupported output format: %s" % args.format)
+
+    jobs = []
+    skipped = 0
+    for source, name in collectInputs(args.inputs, args.recursive):
+        destination = outputPath(name, args.output, extension)
+        if not args.overwrite and os.path.exists(destination):
+            skipped += 1
+        else:
+            jobs.append((source, destination))
+
+    print("%d images to process, %d already done" % (len(jobs), skipped))
+
+    done = 0
+    failed = 0
+    pixels = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=startWorker,
+                             initargs=(model_name, args.rembg_threads, args.rembg_proxy,
+                                       args.cache, args.cache_mb * 2**20)) as pool:
+        futures = {pool.submit(processFile, source, destination, steps): source
+                   for source, destination in jobs}
+
+        for future in as_completed(futures):
+            try:
+                pixels += future.result()
+                done += 1
+            except Exception as error:
+                failed += 1
+                print("failed: %s (%s)" % (futures[future], error), file=sys.stderr)
+
+            if (done + failed) % 100 == 0:
+                elapsed = time.perf_counter() - start
+                print("%d/%d  %.1f images/s" % (done + failed, len(jobs), done / elapsed))
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    print("processed %d images (%.1f MP) in %.1f s: %.2f images/s, %.1f MP/s, %d failed"
+          % (done, pixels / 1e6, elapsed, done / elapsed, pixels / 1e6 / elapsed, failed))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+os.environ.setdefault("ARTMACHINE_REMBG_WARMUP", "0")
+# Every run has to compute from scratch, so results are not kept on disk either.
+os.environ.setdefault("ARTMACHINE_CACHE_MB", "0")
+
+import PIL
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PySide6.QtCore import QEventLoop
+from PySide6.QtWidgets import QApplication
+
+from common import syntheticImage
+from recipe import Step
+
+
+# Name, then what to call on the window. Each runs on the freshly opened image with an empty
+# recipe cache, through the same job, history and display path as the menu action.
+OPERATIONS = [
+    ("drawImage", lambda window: window.drawImage()),
+    ("imageContrast", lambda window: window.imageContrast()),
+    ("imageBrightness", lambda window: window.imageBrightness()),
+    ("imageGray", lambda window: window.imageGray()),
+    ("imageInvert", lambda window: window.imageInvert()),
+    ("rotateClockwise", lambda window: window.rotateClockwise()),
+    ("rotateAnticlockwise", lambda window: window.rotateAnticlockwise()),
+    ("rotateHalf", lambda window: window.rotateHalf()),
+    ("flipHorizontal", lambda window: window.flipHorizontal()),
+    ("flipVertical", lambda window: window.flipVertical()),
+    ("crop", lambda window: window.applyOperation("Crop", Step("crop", box=centerBox(window.document.image.size)),
+                                                  "Image successfully cropped")),
+    ("removeBackground", lambda window: window.removeBackground()),
+]
+
+
+def centerBox(size):
+    width, height = size
+    return (width // 4, height // 4, width * 3 // 4, height * 3 // 4)
+
+
+def waitForJob(window):
+    # The job's commit runs inside the slot that emits `stopped`, so it is done when this returns.
+    if window.jobs.busy():
+        loop = QEventLoop()
+        window.jobs.stopped.connect(loop.quit)
+        loop.exec()
+        window.jobs.stopped.disconnect(loop.quit)
+
+
+def lastTiming(window, name=None):
+    trace = window.instrumentation.records[-1]
+    if trace.status != "done" or (name and trace.name != name):
+        raise RuntimeError("%s did not finish: %s" % (trace.name, trace.status))
+    return trace.duration()
+
+
+def rewind(window):
+    # Back to the image as opened, with nothing cached, so every run computes from scratch.
+    while window.history.canUndo():
+        window.undoCommand()
+    recipe = window.document.recipe
+    recipe.reset(recipe.source)
+
+
+def benchmark(window, path, operations, repeat, workdir):
+    results = {}
+
+    def record(name, durations):
+        results[name] = statistics.median(durations)
+        print("  %-20s %9.3f s" % (name, results[name]), flush=True)
+
+    durations = []
+    for run in range(repeat):
+        window.openFile(path)
+        waitForJob(window)
+        durations.append(lastTiming(window, "Opening"))
+    record("open", durations)
+
+    for name, operation in operations:
+        durations = []
+        for run in range(repeat):
+            rewind(window)
+            operation(window)
+            waitForJob(window)
+            durations.append(lastTiming(window))
+        record(name, durations)
+
+    for name in ("undo", "redo"):
+        durations = []
+        for run in range(repeat):
+            rewind(window)
+            window.imageInvert()
+            waitForJob(window)
+            if name == "redo":
+                window.undoCommand()
+            getattr(window, name + "Command")()
+            durations.append(lastTiming(window, name.capitalize()))
+        record(name, durations)
+
+    rewind(window)
+    for extension in (".png", ".jpg"):
+        durations = []
+        target = os.path.join(workdir, "saved" + extension)
+        for run in range(repeat):
+            # What saveFile does once its dialogs are answered, with the default encoder options.
+            document = window.document
+            window.jobs.run("Saving", lambda progress: document.save(target, False, None, progress), lambda patched: None)
+            waitForJob(window)
+            durations.append(lastTiming(window, "Saving"))
+        record("save" + extension, durations)
+
+    return results
+
+
+def compare(results, baseline, tolerance, floor):
+    # Ratios against the baseline; only entries measured in both runs are compared, and ones
+    # under `floor` seconds in both are too noisy to call a regression.
+    regressions = []
+    print("\n%-34s %9s %9s %8s" % ("benchmark", "seconds", "baseline", "change"))
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        change = results[key] / baseline[key] - 1 if baseline[key] else 0
+        flag = ""
+        if max(results[key], baseline[key]) < floor:
+            pass
+        elif change > tolerance:
+            flag = "  slower"
+            regressions.append(key)
+        elif change < -tolerance:
+            flag = "  faster"
+        print("%-34s %9.3f %9.3f %+7.0f%%%s" % (key, results[key], baseline[key], change * 100, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time every image operation of the Artmachine window on synthetic "
+                                                 "images, headless, and compare against a saved baseline.")
+    parser.add_argument("--megapixels", type=float, nargs="+", default=[1, 10, 100], help="image sizes to test")
+    parser.add_argument("--modes", nargs="+", default=["L", "RGB", "RGBA"], choices=["L", "RGB", "RGBA"])
+    parser.add_argument("--operations", nargs="+", help="only these operations (open, save and undo always run)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per operation; the median is reported")
+    parser.add_argument("--model", default="u2netp", help="rembg model for removeBackground")
+    parser.add_argument("--skip-rembg", action="store_true", help="leave out removeBackground")
+    parser.add_argument("--save-baseline", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare against a JSON file written by --save-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="relative change reported as a regression")
+    parser.add_argument("--floor", type=float, default=0.02, help="never flag operations faster than this (seconds)")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication([])
+    from Artmachine import MainWindow
+    window = MainWindow(app)
+
+    operations = [(name, operation) for name, operation in OPERATIONS
+                  if not args.operations or name in args.operations]
+    if not args.skip_rembg and any(name == "removeBackground" for name, operation in operations):
+        try:
+            from segmentation import BackgroundRemover
+            window.remover = BackgroundRemover(args.model, cached_masks=0)
+            window.remover.warmUp()
+            window.document.recipe.options["remover"] = window.remover
+        except Exception as error:
+            args.skip_rembg = True
+            print("removeBackground skipped: %s" % error, file=sys.stderr)
+    if args.skip_rembg:
+        operations = [(name, operation) for name, operation in operations if name != "removeBackground"]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for megapixels in args.megapixels:
+            for mode in args.modes:
+                # RGBA goes through PNG to keep its alpha; the others through JPEG, like photos.
+                path = os.path.join(workdir, "source.png" if mode == "RGBA" else "source.jpg")
+                syntheticImage(megapixels, mode).save(path, quality=90)
+
+                print("%g MP %s" % (megapixels, mode), flush=True)
+                timings = benchmark(window, path, operations, args.repeat, workdir)
+                for name, seconds in timings.items():
+                    results["%s %gMP %s" % (name, megapixels, mode)] = seconds
+
+    window.jobs.cancel()
+    window.history.close()
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"python": platform.python_version(), "pillow": PIL.__version__,
+                       "machine": platform.platform(), "cpus": os.cpu_count(), "results": results},
+                      file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.tolerance, args.floor)
+        if regressions:
+            print("\n%d of the benchmarks are more than %d%% slower" % (len(regressions), args.tolerance * 100))
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
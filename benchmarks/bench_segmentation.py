@@ -0,0 +1,65 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import syntheticImage
+from instrument import peakMemory
+from segmentation import PROXY_SIZE, BackgroundRemover
+
+
+def runPath(path, megapixels, model_name, proxy_size):
+    img = Image.open(path).convert("RGB") if path else syntheticImage(megapixels)
+    remover = BackgroundRemover(model_name, proxy_size=proxy_size, cached_masks=0)
+    remover.warmUp()
+    baseline = peakMemory()
+
+    start = time.perf_counter()
+    mask = remover.mask(img)
+    elapsed = time.perf_counter() - start
+
+    peak = peakMemory()
+    return elapsed, (peak - baseline) if peak is not None else None, np.asarray(mask)
+
+
+def measure(path, megapixels, model_name, proxy_size):
+    # Every path runs in a fresh process so the peak memory of one does not hide the other.
+    with multiprocessing.get_context("spawn").Pool(1) as pool:
+        return pool.apply(runPath, (path, megapixels, model_name, proxy_size))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare full resolution and proxy background removal.")
+    parser.add_argument("images", nargs="*", help="photos to segment (a synthetic image is used when omitted)")
+    parser.add_argument("--megapixels", type=float, default=24, help="size of the synthetic image")
+    parser.add_argument("--model", default="u2netp", help="rembg model")
+    parser.add_argument("--proxy", type=int, default=PROXY_SIZE, help="longest side of the proxy")
+    args = parser.parse_args(argv)
+
+    print("%-28s %-6s %9s %10s %7s %7s" % ("image", "path", "seconds", "peak MB", "IoU", "MAE"))
+    for path in args.images or [None]:
+        name = os.path.basename(path) if path else "synthetic %g MP" % args.megapixels
+        full_time, full_memory, full_mask = measure(path, args.megapixels, args.model, 0)
+        proxy_time, proxy_memory, proxy_mask = measure(path, args.megapixels, args.model, args.proxy)
+
+        # Quality is measured against the full resolution mask.
+        full_on = full_mask > 127
+        proxy_on = proxy_mask > 127
+        union = np.logical_or(full_on, proxy_on).sum()
+        iou = np.logical_and(full_on, proxy_on).sum() / union if union else 1.0
+        mae = np.abs(full_mask.astype(np.int16) - proxy_mask).mean()
+
+        for label, seconds, memory in (("full", full_time, full_memory), ("proxy", proxy_time, proxy_memory)):
+            megabytes = "%10.0f" % (memory / 2**20) if memory is not None else "%10s" % "n/a"
+            quality = "%7s %7s" % ("", "") if label == "full" else "%7.4f %7.2f" % (iou, mae)
+            print("%-28s %-6s %9.2f %s %s" % (name[:28], label, seconds, megabytes, quality))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,20 @@
+from PIL import Image, ImageDraw, ImageFilter
+
+
+def syntheticImage(megapixels, mode="RGB"):
+    # A 4:3 picture with smooth gradients, hard edges and a soft alpha edge, so filters, the
+    # encoders and the segmentation model all have something realistic to chew on.
+    width = int((megapixels * 1e6 * 4 / 3) ** 0.5)
+    height = int(width * 3 / 4)
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    draw.ellipse((width // 5, height // 6, width * 3 // 5, height * 5 // 6), fill=(200, 120, 80))
+    draw.rectangle((width // 2, height // 3, width * 4 // 5, height * 2 // 3), fill=(60, 140, 200))
+    img = img.filter(ImageFilter.GaussianBlur(2))
+
+    if mode == "L":
+        return img.convert("L")
+    if mode == "RGBA":
+        alpha = Image.radial_gradient("L").resize((width, height)).point(lambda value: 255 - value)
+        img.putalpha(alpha)
+    return img
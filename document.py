@@ -0,0 +1,278 @@
+import io
+import os
+
+from PIL import ExifTags, Image
+
+from instrument import phase
+from recipe import SWAPPING_TRANSPOSES, Recipe
+
+
+ORIENTATION_TAG = 0x0112
+
+# The transpose that shows a stored image the way each EXIF orientation value asks for.
+ORIENTATION_TRANSPOSE = {
+    1: None,
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".jpe")
+
+# Extensions and default encoder settings of every format images can be saved as.
+SAVE_FORMATS = {
+    "PNG": ((".png",), {"compress_level": 6, "optimize": False}),
+    "JPEG": (JPEG_EXTENSIONS, {"quality": 90, "progressive": False, "subsampling": "4:2:0"}),
+    "WEBP": ((".webp",), {"quality": 90, "lossless": False, "method": 4}),
+    "TIFF": ((".tif", ".tiff"), {"compression": "tiff_lzw"}),
+}
+
+
+class ImageDocument:
+    def __init__(self, recipe=None):
+        self.recipe = recipe or Recipe()
+        self.image = None
+        self.path = None
+        self.format = None
+        self.info = {}
+        # EXIF orientation that turns the pixels stored in the file into the current image,
+        # or None once the image was changed by anything other than rotations and flips.
+        self.orientation = None
+        self.source_orientation = 1
+
+    def hasImage(self):
+        return self.image is not None
+
+    def open(self, path):
+        return self.load(path, *decodeImage(path))
+
+    def load(self, path, image, format, orientation, info):
+        # Takes what decodeImage(path) returned, usually on a worker thread.
+        self.path = path
+        self.format = format
+        # The pixels were turned upright when decoded; the file still stores them turned.
+        self.source_orientation = orientation
+        self.orientation = orientation
+        self.info = info
+        self.image = image
+        self.recipe.reset(self.image)
+
+        return self.image
+
+    def state(self):
+        return self.recipe.steps
+
+    def setImage(self, image, steps=()):
+        # `image` is what `steps` render to from the opened file.
+        self.image = image
+        self.recipe.steps = tuple(steps)
+        self.orientation = stepsOrientation(steps, self.source_orientation)
+
+    def canSaveLossless(self, path):
+        return (self.orientation is not None and self.format == "JPEG"
+                and os.path.splitext(path)[1].lower() in JPEG_EXTENSIONS)
+
+    def save(self, path, lossless=False, options=None, progress=None):
+        # Encodes from memory and may run on a worker thread; `options` override the encoder
+        # defaults of the format. The file is written next to `path` and renamed when complete,
+        # and a cancelled save (progress raising) leaves whatever was at `path` untouched.
+        image = self.image
+        partial = path + ".part"
+        lossless = lossless and self.canSaveLossless(path)
+        data = None
+
+        # A JPEG that was only rotated or flipped can be written as the original file with a
+        # new orientation tag, which keeps every compressed byte of the image as it was.
+        if lossless:
+            with open(self.path, "rb") as file:
+                data = setJpegOrientation(file.read(), self.orientation)
+
+        try:
+            with phase("encode"):
+                if data is not None:
+                    with open(partial, "wb") as file:
+                        file.write(data)
+                else:
+                    format = saveFormat(path) or Image.registered_extensions().get(os.path.splitext(path)[1].lower())
+                    settings = dict(SAVE_FORMATS[format][1], **(options or {})) if format in SAVE_FORMATS else {}
+                    encodableImage(image, format).save(partial, format=format, **dict(self.info, **settings))
+            if progress is not None:
+                progress(1)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+
+        os.replace(partial, path)
+        return data is not None
+
+
+def saveFormat(path):
+    extension = os.path.splitext(path)[1].lower()
+    for format, (extensions, defaults) in SAVE_FORMATS.items():
+        if extension in extensions:
+            return format
+    return None
+
+
+def encodableImage(img, format):
+    # JPEG has no alpha and only 8-bit samples, WebP only 8-bit RGB(A); transparent areas
+    # become white and high bit depth images keep their top 8 bits.
+    if format in ("JPEG", "WEBP") and img.mode in ("I;16", "I", "F"):
+        img = img.convert("I").point(lambda value: value / 256).convert("L")
+    if format == "JPEG" and img.mode == "RGBA":
+        flat = Image.new("RGB", img.size, (255, 255, 255))
+        flat.paste(img, mask=img.getchannel("A"))
+        return flat
+    return img
+
+
+def normalizeMode(img):
+    # Operations work on L, RGB and RGBA; high bit depth modes are kept as they are.
+    if img.mode in ("L", "RGB", "RGBA", "I;16", "I", "F"):
+        return img
+    if img.mode in ("P", "PA"):
+        if img.mode == "PA" or "transparency" in img.info:
+            return img.convert("RGBA")
+        return img.convert("RGB")
+    if img.mode == "LA":
+        return img.convert("RGBA")
+    if img.mode == "1":
+        return img.convert("L")
+    return img.convert("RGB")
+
+
+def exifOrientation(img):
+    orientation = img.getexif().get(ORIENTATION_TAG, 1)
+    return orientation if orientation in ORIENTATION_TRANSPOSE else 1
+
+
+def decodeImage(path):
+    # The full decode. The EXIF orientation is applied to the pixels here, once, so nothing
+    # after this has to know about it; the tag itself is not carried over to saved files.
+    with phase("decode"), Image.open(path) as img:
+        img.load()
+        orientation = exifOrientation(img)
+        info = {key: img.info[key] for key in ("icc_profile", "dpi") if key in img.info}
+        image = orientImage(normalizeMode(img), orientation)
+        return image, img.format, orientation, info
+
+
+def exifThumbnail(img):
+    # The small JPEG many cameras embed in the EXIF data (IFD1), or None.
+    try:
+        thumbnail = img.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = thumbnail.get(0x0201), thumbnail.get(0x0202)
+        data = img.info.get("exif", b"")
+        if data.startswith(b"Exif\x00\x00"):
+            data = data[6:]
+        if not offset or not length or offset + length > len(data):
+            return None
+        with Image.open(io.BytesIO(data[offset:offset + length])) as thumbnail:
+            thumbnail.load()
+            return normalizeMode(thumbnail)
+    except (OSError, ValueError, KeyError, SyntaxError):
+        return None
+
+
+def openDraft(path, width, height):
+    # Something to show while the full decode runs: JPEGs are decoded at 1/2, 1/4 or 1/8
+    # scale straight from the compressed data, still at least width x height; other formats
+    # fall back to the embedded EXIF thumbnail. Returns the draft, already upright, and the
+    # size of the full upright image; no draft if there is no cheap one or no need for it.
+    with Image.open(path) as img:
+        orientation = exifOrientation(img)
+        size = img.size
+        if ORIENTATION_TRANSPOSE[orientation] in SWAPPING_TRANSPOSES:
+            size = (size[1], size[0])
+
+        draft = None
+        if img.format == "JPEG":
+            stored = img.size
+            img.draft(None, (width, height))
+            if img.size != stored:
+                img.load()
+                draft = normalizeMode(img)
+        elif img.width > width or img.height > height:
+            draft = exifThumbnail(img)
+
+        if draft is not None:
+            draft = orientImage(draft, orientation)
+        return draft, size
+
+
+def orientImage(img, orientation):
+    method = ORIENTATION_TRANSPOSE[orientation]
+    return img if method is None else img.transpose(method)
+
+
+def transposeOrientation(orientation, method):
+    # The orientation equal to `orientation` followed by `method`, found by trying all eight
+    # on a tiny image with no symmetry.
+    if orientation is None:
+        return None
+    probe = Image.frombytes("L", (3, 2), bytes(range(6)))
+    target = orientImage(probe, orientation).transpose(method)
+    for value in ORIENTATION_TRANSPOSE:
+        candidate = orientImage(probe, value)
+        if candidate.size == target.size and candidate.tobytes() == target.tobytes():
+            return value
+
+
+def stepsOrientation(steps, orientation=1):
+    for step in steps:
+        if step.name != "transpose":
+            return None
+        orientation = transposeOrientation(orientation, step.params["method"])
+    return orientation
+
+
+def patchOrientation(exif, orientation):
+    # Overwrites the orientation entry of IFD0 in place; None if there is no such entry.
+    tiff = exif[6:]
+    byteorder = "little" if tiff[:2] == b"II" else "big"
+    offset = int.from_bytes(tiff[4:8], byteorder)
+    count = int.from_bytes(tiff[offset:offset + 2], byteorder)
+
+    for index in range(count):
+        entry = offset + 2 + 12 * index
+        tag = int.from_bytes(tiff[entry:entry + 2], byteorder)
+        kind = int.from_bytes(tiff[entry + 2:entry + 4], byteorder)
+        if tag == ORIENTATION_TAG and kind == 3:
+            value = 6 + entry + 8
+            return exif[:value] + orientation.to_bytes(2, byteorder) + exif[value + 2:]
+    return None
+
+
+def setJpegOrientation(data, orientation):
+    # Returns the JPEG file `data` with its EXIF orientation set, without decoding anything.
+    # None if the file has EXIF data that cannot be changed in place.
+    if data[:2] != b"\xff\xd8":
+        return None
+
+    position = 2
+    insert_at = 2
+    while position + 4 <= len(data) and data[position] == 0xFF:
+        marker = data[position + 1]
+        if marker in (0xDA, 0xD9):
+            break
+        end = position + 2 + int.from_bytes(data[position + 2:position + 4], "big")
+        segment = data[position + 4:end]
+
+        if marker == 0xE0:
+            insert_at = end
+        elif marker == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            patched = patchOrientation(segment, orientation)
+            if patched is None:
+                return None
+            return data[:position + 4] + patched + data[end:]
+        position = end
+
+    exif = Image.Exif()
+    exif[ORIENTATION_TAG] = orientation
+    payload = exif.tobytes()
+    return data[:insert_at] + b"\xff\xe1" + (len(payload) + 2).to_bytes(2, "big") + payload + data[insert_at:]
@@ -0,0 +1,43 @@
+from functools import partial
+
+import numpy as np
+from PIL import Image, ImageFilter
+
+from tiling import gaussianHalo, processTiled
+
+
+SKETCH_RADIUS = 2.5
+
+
+def dodgeArray(grey, blur, out=None):
+    # Colour dodge in 8.8 fixed point: grey * 256 // blur clipped to 255, and 0 where blur is 0.
+    # This matches the old ImageMath "convert(a * 256/b, 'L')" expression bit for bit.
+    work = grey.astype(np.uint16)
+    work <<= 8
+
+    nonzero = blur != 0
+    np.floor_divide(work, blur, out=work, where=nonzero)
+    np.logical_not(nonzero, out=nonzero)
+    np.putmask(work, nonzero, 0)
+    np.minimum(work, 255, out=work)
+
+    if out is None:
+        out = np.empty(grey.shape, np.uint8)
+    np.copyto(out, work, casting="unsafe")
+    return out
+
+
+def sketchArray(grey, radius=SKETCH_RADIUS, out=None):
+    # `grey` is an L image; it is blurred once and each of the two is read into an array once.
+    blur = grey.filter(ImageFilter.GaussianBlur(radius = radius))
+    return dodgeArray(np.asarray(grey), np.asarray(blur), out)
+
+
+def pencilSketch(img, radius=SKETCH_RADIUS):
+    grey = img if img.mode == "L" else img.convert("L")
+    return Image.fromarray(sketchArray(grey, radius))
+
+
+def sketchImage(img, radius=SKETCH_RADIUS, **options):
+    return processTiled(img, partial(pencilSketch, radius=radius), gaussianHalo(radius), **options)
+
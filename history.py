@@ -0,0 +1,282 @@
+import os
+import shutil
+import tempfile
+import weakref
+
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+BAND_BYTES = {"I;16": 2, "I": 4, "F": 4}
+
+INVERSE_TRANSPOSE = {
+    Image.FLIP_LEFT_RIGHT: Image.FLIP_LEFT_RIGHT,
+    Image.FLIP_TOP_BOTTOM: Image.FLIP_TOP_BOTTOM,
+    Image.ROTATE_90: Image.ROTATE_270,
+    Image.ROTATE_180: Image.ROTATE_180,
+    Image.ROTATE_270: Image.ROTATE_90,
+    Image.TRANSPOSE: Image.TRANSPOSE,
+    Image.TRANSVERSE: Image.TRANSVERSE,
+}
+
+
+def bufferSize(mode, size):
+    return size[0] * size[1] * Image.getmodebands(mode) * BAND_BYTES.get(mode, 1)
+
+
+def imageBytes(img):
+    return bufferSize(img.mode, img.size)
+
+
+def changedTiles(old, new, tile_size):
+    boxes = []
+    cols = np.arange(0, new.width, tile_size)
+
+    # Compare one row of tiles at a time so the scratch memory stays at a single strip.
+    for top in range(0, new.height, tile_size):
+        bottom = min(top + tile_size, new.height)
+        strip = (0, top, new.width, bottom)
+
+        changed = np.asarray(old.crop(strip)) != np.asarray(new.crop(strip))
+        if changed.ndim == 3:
+            changed = changed.any(axis=2)
+        changed = np.logical_or.reduceat(changed.any(axis=0), cols)
+
+        for left in cols[changed]:
+            boxes.append((int(left), top, int(min(left + tile_size, new.width)), bottom))
+
+    return boxes
+
+
+class Snapshot:
+    # Holds the whole image of the state on the other side of the step.
+    def __init__(self, image):
+        self.payload = image
+        self.nbytes = imageBytes(image)
+
+    def swap(self, current):
+        other = self.payload
+        self.payload = current
+        self.nbytes = imageBytes(current)
+        return other
+
+    def dump(self, file):
+        self.meta = (self.payload.mode, self.payload.size)
+        file.write(self.payload.tobytes())
+
+    def load(self, file):
+        mode, size = self.meta
+        self.payload = Image.frombytes(mode, size, file.read())
+
+
+class TileDelta:
+    # Holds only the tiles that differ; swapping them in turns one state into the other.
+    def __init__(self, image, boxes):
+        self.boxes = boxes
+        self.payload = [(box, image.crop(box)) for box in boxes]
+        self.nbytes = sum(imageBytes(tile) for box, tile in self.payload)
+
+    def swap(self, current):
+        # The image handed in may still be shown or cached elsewhere, so it is never changed.
+        current = current.copy()
+        payload = []
+        for box, tile in self.payload:
+            payload.append((box, current.crop(box)))
+            current.paste(tile, box)
+        self.payload = payload
+        return current
+
+    def dump(self, file):
+        self.meta = [(box, tile.mode) for box, tile in self.payload]
+        for box, tile in self.payload:
+            file.write(tile.tobytes())
+
+    def load(self, file):
+        payload = []
+        for box, mode in self.meta:
+            size = (box[2] - box[0], box[3] - box[1])
+            payload.append((box, Image.frombytes(mode, size, file.read(bufferSize(mode, size)))))
+        self.payload = payload
+
+
+class Operation:
+    # Exactly invertible step: nothing but the operation is kept, undo applies its inverse.
+    nbytes = 0
+
+    def __init__(self, forward, inverse):
+        self.forward = forward
+        self.inverse = inverse
+        self.undone = False
+
+    def swap(self, current):
+        operation = self.forward if self.undone else self.inverse
+        self.undone = not self.undone
+        return operation(current)
+
+
+def transposeOperation(method):
+    inverse = INVERSE_TRANSPOSE[method]
+    return Operation(lambda img: img.transpose(method), lambda img: img.transpose(inverse))
+
+
+class History:
+    def __init__(self, memory_budget=512 * 2**20, disk_budget=4 * 2**30, tile_size=256, snapshot_ratio=0.5):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.tile_size = tile_size
+        self.snapshot_ratio = snapshot_ratio
+
+        self.entries = []
+        # Whatever small document state goes with each position, e.g. its EXIF orientation.
+        self.states = [None]
+        self.index = 0
+        self.current = None
+        # Boxes that differ between the last two states the image went through, or None when
+        # the whole image may have changed.
+        self.changed = None
+
+        self.resident = OrderedDict()
+        self.spilled = {}
+        self.memory_used = 0
+        self.disk_used = 0
+
+        self.spill_dir = None
+        self._finalizer = None
+
+    def reset(self, image, state=None):
+        for entry in self.entries:
+            self.discard(entry)
+        self.entries = []
+        self.states = [state]
+        self.index = 0
+        self.current = image
+        self.changed = None
+
+    def push(self, image, state=None):
+        self.append(self.record(self.current, image), image, state)
+
+    def pushOperation(self, image, forward, inverse, state=None):
+        self.append(Operation(forward, inverse), image, state)
+
+    def pushTranspose(self, image, method, state=None):
+        self.append(transposeOperation(method), image, state)
+
+    def append(self, entry, image, state=None):
+        for stale in self.entries[self.index:]:
+            self.discard(stale)
+        del self.entries[self.index:]
+        del self.states[self.index + 1:]
+
+        self.entries.append(entry)
+        self.states.append(state)
+        self.index += 1
+        self.current = image
+        self.changed = getattr(entry, "boxes", None)
+
+        if entry.nbytes:
+            self.resident[id(entry)] = entry
+            self.memory_used += entry.nbytes
+            self.enforceBudget()
+
+    def record(self, old, new):
+        if old.mode != new.mode or old.size != new.size:
+            return Snapshot(old)
+
+        boxes = changedTiles(old, new, self.tile_size)
+        changed = sum((right - left) * (bottom - top) for left, top, right, bottom in boxes)
+        if changed > self.snapshot_ratio * new.width * new.height:
+            return Snapshot(old)
+        return TileDelta(old, boxes)
+
+    def state(self):
+        return self.states[self.index]
+
+    def canUndo(self):
+        return self.index > 0
+
+    def canRedo(self):
+        return self.index < len(self.entries)
+
+    def undo(self):
+        self.index -= 1
+        self.current = self.apply(self.entries[self.index])
+        return self.current
+
+    def redo(self):
+        self.current = self.apply(self.entries[self.index])
+        self.index += 1
+        return self.current
+
+    def apply(self, entry):
+        self.restore(entry)
+
+        self.memory_used -= entry.nbytes
+        current = entry.swap(self.current)
+        self.memory_used += entry.nbytes
+
+        self.changed = getattr(entry, "boxes", None)
+        if id(entry) in self.resident:
+            self.resident.move_to_end(id(entry))
+            self.enforceBudget(keep=entry)
+        return current
+
+    def enforceBudget(self, keep=None):
+        for key in list(self.resident):
+            if self.memory_used <= self.memory_budget:
+                break
+            if self.resident[key] is not keep:
+                self.spill(self.resident[key])
+
+        while self.disk_used > self.disk_budget and self.entries:
+            # Forget the oldest undo step first, the far end of the redo branch after that.
+            if self.index > 0:
+                self.discard(self.entries.pop(0))
+                del self.states[0]
+                self.index -= 1
+            else:
+                self.discard(self.entries.pop())
+                self.states.pop()
+
+    def spill(self, entry):
+        if self.spill_dir is None:
+            self.spill_dir = tempfile.mkdtemp(prefix="artmachine-history-")
+            self._finalizer = weakref.finalize(self, shutil.rmtree, self.spill_dir, True)
+
+        path = os.path.join(self.spill_dir, "%d.raw" % id(entry))
+        with open(path, "wb") as file:
+            entry.dump(file)
+        entry.payload = None
+
+        del self.resident[id(entry)]
+        self.spilled[id(entry)] = path
+        self.memory_used -= entry.nbytes
+        self.disk_used += entry.nbytes
+
+    def restore(self, entry):
+        path = self.spilled.pop(id(entry), None)
+        if path is None:
+            return
+
+        with open(path, "rb") as file:
+            entry.load(file)
+        os.remove(path)
+
+        self.resident[id(entry)] = entry
+        self.memory_used += entry.nbytes
+        self.disk_used -= entry.nbytes
+
+    def discard(self, entry):
+        path = self.spilled.pop(id(entry), None)
+        if path is not None:
+            os.remove(path)
+            self.disk_used -= entry.nbytes
+        elif self.resident.pop(id(entry), None) is not None:
+            self.memory_used -= entry.nbytes
+        entry.payload = None
+
+    def close(self):
+        self.reset(None)
+        if self._finalizer is not None:
+            self._finalizer()
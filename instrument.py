@@ -0,0 +1,189 @@
+import ctypes
+import json
+import os
+import sys
+import threading
+import time
+
+from collections import deque
+from contextlib import contextmanager, nullcontext
+
+
+_local = threading.local()
+
+
+class ProcessMemoryCounters(ctypes.Structure):
+    _fields_ = [("cb", ctypes.c_ulong), ("PageFaultCount", ctypes.c_ulong),
+                ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+
+def peakMemory():
+    # Highest resident memory of the process so far in bytes, or None where it is not known.
+    # Pillow allocates outside the Python heap, so this is the one number that sees it all.
+    if sys.platform == "win32":
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.kernel32.K32GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Trace:
+    # The timings of one operation: a list of phases, each timed on the thread that ran it.
+    # Phases nest; code anywhere below a phase adds its own through phase(name).
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.status = "done"
+        self.phases = []
+        self.info = {}
+        self.peak_memory = peakMemory()
+        self.memory_growth = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        previous = getattr(_local, "trace", None), getattr(_local, "depth", 0)
+        depth = previous[1] if previous[0] is self else 0
+        _local.trace, _local.depth = self, depth + 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            _local.trace, _local.depth = previous
+            with self._lock:
+                self.phases.append((name, start, end, threading.get_ident(), depth))
+
+    def addPhase(self, name, start, end):
+        with self._lock:
+            self.phases.append((name, start, end, threading.get_ident(), 0))
+
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def summary(self):
+        # Top level phases in the order they started.
+        with self._lock:
+            phases = sorted((phase for phase in self.phases if phase[4] == 0), key=lambda phase: phase[1])
+        return [(name, end - start) for name, start, end, thread, depth in phases]
+
+
+def current():
+    return getattr(_local, "trace", None)
+
+
+def phase(name):
+    trace = current()
+    return trace.phase(name) if trace is not None else nullcontext()
+
+
+def note(key, value):
+    trace = current()
+    if trace is not None:
+        trace.info[key] = value
+
+
+class Instrumentation:
+    # Collects a Trace for every operation of the window. Keeping them is cheap (a few clock
+    # reads per phase); the last `limit` are kept for export, and with `path` set each one is
+    # also appended there as a JSON line as soon as it is finished.
+    def __init__(self, limit=1000, path=None):
+        self.records = deque(maxlen=limit)
+        self.path = path
+        self.listeners = []
+        self.origin = time.perf_counter()
+        self.wall_origin = time.time()
+        self._lock = threading.Lock()
+
+    def begin(self, name):
+        return Trace(name)
+
+    def finish(self, trace, status=None):
+        if trace.end is not None:
+            return
+        trace.end = time.perf_counter()
+        if status is not None:
+            trace.status = status
+        peak = peakMemory()
+        if peak is not None and trace.peak_memory is not None:
+            trace.memory_growth = peak - trace.peak_memory
+        trace.peak_memory = peak
+
+        with self._lock:
+            self.records.append(trace)
+        if self.path:
+            with open(self.path, "a") as file:
+                file.write(json.dumps(self.record(trace)) + "\n")
+        for listener in self.listeners:
+            listener(trace)
+
+    @contextmanager
+    def measure(self, name):
+        # For operations that run start to finish on the calling thread.
+        trace = self.begin(name)
+        try:
+            with trace.phase("run"):
+                yield trace
+        except BaseException:
+            self.finish(trace, "failed")
+            raise
+        self.finish(trace)
+
+    def record(self, trace):
+        size = trace.info.get("size")
+        with trace._lock:
+            phases = sorted(trace.phases, key=lambda phase: phase[1])
+        return {
+            "name": trace.name,
+            "status": trace.status,
+            "time": self.wall_origin + trace.start - self.origin,
+            "duration": trace.duration(),
+            "phases": [{"name": name, "start": start - trace.start, "duration": end - start,
+                        "thread": thread, "depth": depth}
+                       for name, start, end, thread, depth in phases],
+            "size": list(size) if size else None,
+            "megapixels": size[0] * size[1] / 1e6 if size else None,
+            "peak_memory": trace.peak_memory,
+            "memory_growth": trace.memory_growth,
+            "info": {key: value for key, value in trace.info.items() if key != "size"},
+        }
+
+    def exportJsonLines(self, path):
+        with self._lock:
+            traces = list(self.records)
+        with open(path, "w") as file:
+            for trace in traces:
+                file.write(json.dumps(self.record(trace)) + "\n")
+
+    def exportChromeTrace(self, path):
+        # The Trace Event Format read by chrome://tracing and Perfetto: one complete ("X")
+        # event per operation and per phase, on the thread that ran it.
+        with self._lock:
+            traces = list(self.records)
+        pid = os.getpid()
+        events = []
+        for trace in traces:
+            record = self.record(trace)
+            events.append({"name": trace.name, "cat": "operation", "ph": "X", "pid": pid, "tid": 0,
+                           "ts": (trace.start - self.origin) * 1e6, "dur": trace.duration() * 1e6,
+                           "args": {key: record[key] for key in ("status", "size", "peak_memory", "memory_growth")}})
+            for item in record["phases"]:
+                events.append({"name": item["name"], "cat": trace.name, "ph": "X", "pid": pid,
+                               "tid": item["thread"],
+                               "ts": (trace.start - self.origin + item["start"]) * 1e6,
+                               "dur": item["duration"] * 1e6})
+        with open(path, "w") as file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, file)
@@ -0,0 +1,196 @@
+import threading
+import time
+
+from contextlib import nullcontext
+
+from PySide6.QtCore import QObject, QRunnable, QThreadPool, QTimer, Signal
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobSignals(QObject):
+    progress = Signal(object, float)
+    finished = Signal(object, object)
+    failed = Signal(object, str)
+    done = Signal(object)
+
+
+class Job(QRunnable):
+    def __init__(self, name, function, trace=None):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.name = name
+        self.function = function
+        self.trace = trace
+        self.submitted = time.perf_counter()
+        self.signals = JobSignals()
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def progress(self, fraction):
+        # Handed to the operation; long running operations call it between chunks of work.
+        if self.cancelled():
+            raise JobCancelled()
+        self.signals.progress.emit(self, fraction)
+
+    def run(self):
+        context = nullcontext()
+        if self.trace is not None:
+            self.trace.addPhase("queue", self.submitted, time.perf_counter())
+            context = self.trace.phase("compute")
+        try:
+            with context:
+                result = self.function(self.progress)
+        except JobCancelled:
+            pass
+        except Exception as error:
+            self.signals.failed.emit(self, str(error) or type(error).__name__)
+        else:
+            self.signals.finished.emit(self, result)
+        finally:
+            self.signals.done.emit(self)
+
+
+class JobManager(QObject):
+    started = Signal(str)
+    progressed = Signal(float)
+    stopped = Signal()
+    failed = Signal(str, str)
+
+    def __init__(self, parent=None, instrumentation=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.instrumentation = instrumentation
+        self.profiler = None
+        self.job = None
+        self.commit = None
+        self.running = set()
+
+    def busy(self):
+        return self.job is not None
+
+    def name(self):
+        return self.job.name if self.job else None
+
+    def run(self, name, function, commit, trace=None):
+        # function(progress) runs on a worker thread; commit(result) runs afterwards on the GUI
+        # thread, so everything that touches the document happens in one step there. With
+        # instrumentation, the job is timed as queue, compute and commit phases of `trace`.
+        if trace is None and self.instrumentation is not None:
+            trace = self.instrumentation.begin(name)
+        if self.profiler is not None:
+            function = self.profiler.wrapJob(function)
+        job = Job(name, function, trace)
+        job.signals.progress.connect(self.jobProgress)
+        job.signals.finished.connect(self.jobFinished)
+        job.signals.failed.connect(self.jobFailed)
+        job.signals.done.connect(self.jobDone)
+
+        self.running.add(job)
+        self.job = job
+        self.commit = commit
+        self.started.emit(name)
+        self.pool.start(job)
+
+    def cancel(self):
+        # The worker may still be busy inside a call that cannot be interrupted; it is left to
+        # finish in the background and whatever it returns is dropped.
+        if self.job is not None:
+            job = self.job
+            job.cancel()
+            self.release()
+            self.finish(job, "cancelled")
+
+    def release(self):
+        self.job = None
+        self.commit = None
+        self.stopped.emit()
+
+    def jobProgress(self, job, fraction):
+        if job is self.job:
+            self.progressed.emit(fraction)
+
+    def finish(self, job, status=None):
+        if job.trace is not None and self.instrumentation is not None:
+            self.instrumentation.finish(job.trace, status)
+
+    def jobFinished(self, job, result):
+        if job is self.job and not job.cancelled():
+            commit = self.commit
+            self.release()
+            with job.trace.phase("commit") if job.trace is not None else nullcontext():
+                commit(result)
+            self.finish(job)
+
+    def jobDone(self, job):
+        self.running.discard(job)
+
+    def jobFailed(self, job, message):
+        if job is self.job:
+            self.release()
+            self.finish(job, "failed")
+            self.failed.emit(job.name, message)
+
+
+class PreviewScheduler(QObject):
+    # Renders previews for a stream of requests (e.g. slider moves). Requests are coalesced
+    # over a short delay, only one render runs at a time, and a request that arrives while one
+    # is running simply replaces whatever was still queued, so the latest value always wins.
+    ready = Signal(object)
+
+    def __init__(self, render, delay=15, parent=None):
+        super().__init__(parent)
+        self.render = render
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.dispatch)
+
+        self.pending = None
+        self.job = None
+        self.active = True
+
+    def request(self, value):
+        if self.active:
+            self.pending = (value,)
+            # Not restarted by later requests, so a steady stream still renders every `delay` ms.
+            if not self.timer.isActive():
+                self.timer.start()
+
+    def dispatch(self):
+        if self.job is not None or self.pending is None:
+            return
+
+        value, = self.pending
+        self.pending = None
+
+        self.job = Job("Preview", lambda progress: self.render(value))
+        self.job.signals.finished.connect(self.rendered)
+        self.job.signals.failed.connect(self.renderFailed)
+        self.pool.start(self.job)
+
+    def rendered(self, job, result):
+        self.job = None
+        if self.active:
+            self.ready.emit(result)
+            self.dispatch()
+
+    def renderFailed(self, job, message):
+        self.job = None
+        if self.active:
+            self.dispatch()
+
+    def stop(self):
+        self.active = False
+        self.pending = None
+        self.timer.stop()
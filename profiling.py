@@ -0,0 +1,167 @@
+import cProfile
+import os
+import pstats
+import re
+import sys
+import threading
+import tracemalloc
+
+from collections import Counter
+
+
+class StackSampler:
+    # Looks at the Python stack of every other thread `interval` seconds apart, from a thread
+    # of its own, so work on the GUI thread and in the job pool shows up alike. The counts are
+    # written in the collapsed format read by flamegraph.pl, speedscope and inferno.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.counts = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def run(self):
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                if ident not in names:
+                    names.update((thread.ident, thread.name) for thread in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%d" % ident))
+                self.counts[tuple(reversed(stack))] += 1
+
+    def write(self, path):
+        with open(path, "w") as file:
+            for stack, count in self.counts.most_common():
+                file.write("%s %d\n" % (";".join(frame.replace(";", ":") for frame in stack), count))
+
+
+class ProfileSession:
+    def __init__(self, name, interval):
+        self.name = name
+        self.profile = cProfile.Profile()
+        self.worker_profiles = []
+        self.sampler = StackSampler(interval)
+        self.snapshot = None
+        self.owns_tracemalloc = False
+        self._lock = threading.Lock()
+
+    def addProfile(self, profile):
+        with self._lock:
+            self.worker_profiles.append(profile)
+
+
+class ActionProfiler:
+    # Profiles one window action at a time, from the moment its slot is called until the job
+    # it started (if any) has been committed. Each action leaves three files in `directory`:
+    # a pstats file with the GUI thread and the job merged, collapsed stacks sampled from all
+    # threads, and the Python allocations made during the action that were still alive at
+    # its end, by traceback. `busy` tells whether a job is still running.
+    def __init__(self, directory, busy, interval=0.005, frames=25):
+        self.directory = directory
+        self.busy = busy
+        self.interval = interval
+        self.frames = frames
+        self.count = 0
+        self.session = None
+        os.makedirs(directory, exist_ok=True)
+
+    def wrap(self, slot):
+        name = slot.__name__
+
+        def profiledSlot(checked=False):
+            if self.session is not None:
+                # The previous action is still running; this one is part of its profile.
+                return slot()
+            self.begin(name)
+            try:
+                return slot()
+            finally:
+                if not self.busy():
+                    self.end()
+
+        return profiledSlot
+
+    def wrapJob(self, function):
+        session = self.session
+        if session is None:
+            return function
+
+        def profiledJob(progress):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                # Python 3.12+ allows one profiler per process, and there the one on the GUI
+                # thread already sees every thread.
+                return function(progress)
+            try:
+                return function(progress)
+            finally:
+                profile.disable()
+                session.addProfile(profile)
+
+        return profiledJob
+
+    def traceFinished(self, trace):
+        if self.session is not None and not self.busy():
+            self.end()
+
+    def begin(self, name):
+        session = ProfileSession(name, self.interval)
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            session.owns_tracemalloc = True
+        session.snapshot = tracemalloc.take_snapshot()
+        session.sampler.start()
+        self.session = session
+        session.profile.enable()
+
+    def end(self):
+        session = self.session
+        if session is None:
+            return
+        self.session = None
+        session.profile.disable()
+        session.sampler.stop()
+        snapshot = tracemalloc.take_snapshot()
+        if session.owns_tracemalloc:
+            tracemalloc.stop()
+
+        self.count += 1
+        base = os.path.join(self.directory, "%03d-%s" % (self.count, re.sub(r"\W+", "_", session.name)))
+
+        stats = pstats.Stats(session.profile)
+        for profile in session.worker_profiles:
+            stats.add(profile)
+        stats.dump_stats(base + ".pstats")
+        session.sampler.write(base + ".collapsed")
+        self.writeAllocations(base + ".memory.txt", snapshot, session.snapshot)
+        print("profile of %s written to %s.*" % (session.name, base), file=sys.stderr)
+
+    def writeAllocations(self, path, snapshot, baseline, limit=25):
+        # tracemalloc sees the Python heap and NumPy arrays; Pillow's pixel buffers are not on it.
+        ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        differences = snapshot.filter_traces(ignore).compare_to(baseline.filter_traces(ignore), "traceback")
+        with open(path, "w") as file:
+            file.write("%s: allocations still alive after the action, largest first\n\n" % os.path.basename(path))
+            for difference in [difference for difference in differences if difference.size_diff > 0][:limit]:
+                file.write("%+.1f KiB in %+d blocks\n" % (difference.size_diff / 1024, difference.count_diff))
+                for line in difference.traceback.format(most_recent_first=True):
+                    file.write("  %s\n" % line)
+                file.write("\n")
@@ -0,0 +1,315 @@
+import json
+import threading
+
+from collections import OrderedDict
+
+from PIL import Image
+
+from adjustments import PointPipeline, brightnessImage, contrastImage, gammaImage, grayImage, invertImage
+from filters import SKETCH_RADIUS, sketchImage
+from history import INVERSE_TRANSPOSE, imageBytes
+from instrument import phase
+from tiling import gaussianHalo, haloBox
+
+
+TRANSPOSE_NAMES = {
+    Image.FLIP_LEFT_RIGHT: "Flip Horizontal",
+    Image.FLIP_TOP_BOTTOM: "Flip Vertical",
+    Image.ROTATE_90: "Rotate 90 Anti-Clockwise",
+    Image.ROTATE_180: "Rotate 180",
+    Image.ROTATE_270: "Rotate 90 Clockwise",
+    Image.TRANSPOSE: "Transpose",
+    Image.TRANSVERSE: "Transverse",
+}
+
+BACKGROUND_NAMES = ["Transparent", "White", "Black"]
+
+
+def cropBox(box, size):
+    # A box chosen on one version of the image may not fit once an earlier step changed.
+    left, top, right, bottom = (int(value) for value in box)
+    left, top = min(max(left, 0), size[0] - 1), min(max(top, 0), size[1] - 1)
+    return (left, top, min(max(right, left + 1), size[0]), min(max(bottom, top + 1), size[1]))
+
+
+def tiled(options):
+    return {"progress": options.get("progress"), "workers": options.get("workers")}
+
+
+# Every operation a recipe can hold, as operation(img, options, **params). The options carry
+# the progress callback, the tile worker count and the shared BackgroundRemover.
+OPERATIONS = {
+    "crop": lambda img, options, box: img.crop(cropBox(box, img.size)),
+    "transpose": lambda img, options, method: img.transpose(method),
+    "gray": lambda img, options: grayImage(img, **tiled(options)),
+    "invert": lambda img, options: invertImage(img, **tiled(options)),
+    "contrast": lambda img, options, factor: contrastImage(img, factor, **tiled(options)),
+    "brightness": lambda img, options, factor: brightnessImage(img, factor, **tiled(options)),
+    "gamma": lambda img, options, gamma: gammaImage(img, gamma, **tiled(options)),
+    "sketch": lambda img, options, radius=SKETCH_RADIUS: sketchImage(img, radius, **tiled(options)),
+    "rembg": lambda img, options, background=0: options["remover"].removeBackground(img, background),
+}
+
+# Operations whose every output pixel depends only on the same input pixel.
+POINT_OPERATIONS = ("gray", "invert", "brightness", "gamma")
+# Adjustments a PointPipeline folds together; a run of them in a recipe is one pass.
+ADJUSTMENT_OPERATIONS = POINT_OPERATIONS + ("contrast",)
+# Slow enough that their results are kept on disk, when the recipe is given a ResultCache.
+PERSISTENT_OPERATIONS = ("sketch", "rembg")
+
+SWAPPING_TRANSPOSES = (Image.ROTATE_90, Image.ROTATE_270, Image.TRANSPOSE, Image.TRANSVERSE)
+
+
+class Step:
+    # One parameterised operation. Steps never change once made, so a tuple of them is a
+    # hashable description of an image and can key the cache directly.
+    def __init__(self, name, **params):
+        if name not in OPERATIONS:
+            raise ValueError("unknown operation: %s" % name)
+        self.name = name
+        self.params = {key: tuple(value) if isinstance(value, list) else value for key, value in params.items()}
+        self.key = (name,) + tuple(sorted(self.params.items()))
+
+    def __eq__(self, other):
+        return isinstance(other, Step) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return "Step(%r)" % (self.key,)
+
+    def replace(self, **params):
+        return Step(self.name, **dict(self.params, **params))
+
+    def label(self):
+        if self.name == "transpose":
+            return TRANSPOSE_NAMES[self.params["method"]]
+        if self.name == "rembg":
+            return "Background Removal (%s)" % BACKGROUND_NAMES[self.params.get("background", 0)]
+        if self.name == "crop":
+            return "Crop %d, %d, %d, %d" % self.params["box"]
+        values = ", ".join("%g" % value for key, value in sorted(self.params.items()))
+        title = {"gray": "Grayscale", "sketch": "Picture Drawing"}.get(self.name, self.name.capitalize())
+        return "%s (%s)" % (title, values) if values else title
+
+
+def stepSize(step, size):
+    if step.name == "crop":
+        left, top, right, bottom = cropBox(step.params["box"], size)
+        return (right - left, bottom - top)
+    if step.name == "transpose" and step.params["method"] in SWAPPING_TRANSPOSES:
+        return (size[1], size[0])
+    return size
+
+
+def transposePoint(method, size, x, y):
+    # Where the corner (x, y) of an image of `size` ends up after the transpose.
+    width, height = size
+    return {
+        Image.FLIP_LEFT_RIGHT: (width - x, y),
+        Image.FLIP_TOP_BOTTOM: (x, height - y),
+        Image.ROTATE_90: (y, width - x),
+        Image.ROTATE_180: (width - x, height - y),
+        Image.ROTATE_270: (height - y, x),
+        Image.TRANSPOSE: (y, x),
+        Image.TRANSVERSE: (height - y, width - x),
+    }[method]
+
+
+def transposeBox(box, size, method):
+    x1, y1 = transposePoint(method, size, box[0], box[1])
+    x2, y2 = transposePoint(method, size, box[2], box[3])
+    return (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+
+
+def sinkCrop(steps, size):
+    # Moves the crop at the end of `steps` as early as it can go without changing the result:
+    # through point operations as it is, through transposes with its box mapped back, into an
+    # earlier crop, and through the sketch filter grown by the filter's halo, with a second
+    # crop after the filter trimming the halo off again. Contrast (its mean depends on every
+    # pixel) and background removal (the network looks at the whole picture) stop it.
+    sizes = [size]
+    for step in steps[:-1]:
+        sizes.append(stepSize(step, sizes[-1]))
+
+    box = cropBox(steps[-1].params["box"], sizes[-1])
+    after = []
+    index = len(steps) - 1
+
+    while index > 0:
+        step = steps[index - 1]
+        input_size = sizes[index - 1]
+
+        if step.name in POINT_OPERATIONS:
+            after.insert(0, step)
+        elif step.name == "transpose":
+            box = transposeBox(box, sizes[index], INVERSE_TRANSPOSE[step.params["method"]])
+            after.insert(0, step)
+        elif step.name == "crop":
+            left, top = cropBox(step.params["box"], input_size)[:2]
+            box = (left + box[0], top + box[1], left + box[2], top + box[3])
+        elif step.name == "sketch":
+            grown = haloBox(box, gaussianHalo(step.params.get("radius", SKETCH_RADIUS)), input_size)
+            inner = (box[0] - grown[0], box[1] - grown[1], box[2] - grown[0], box[3] - grown[1])
+            if grown != box:
+                after.insert(0, Step("crop", box=inner))
+            after.insert(0, step)
+            box = grown
+        else:
+            break
+        index -= 1
+
+    if box == (0, 0) + sizes[index]:
+        return list(steps[:index]) + after
+    return list(steps[:index]) + [Step("crop", box=box)] + after
+
+
+def optimizeSteps(steps, size):
+    # An equivalent sequence that runs the expensive filters on as few pixels as possible.
+    # Only crops move: flips and rotations keep their place, since running them earlier or
+    # later touches the same number of pixels and saves nothing. A crop still passes through
+    # them on its way up, with its box mapped back.
+    optimized = []
+    for step in steps:
+        optimized.append(step)
+        if step.name == "crop":
+            optimized = sinkCrop(optimized, size)
+    return tuple(optimized)
+
+
+def groupSteps(steps):
+    # Runs of consecutive adjustments together, every other step on its own.
+    groups = []
+    for step in steps:
+        if groups and step.name in ADJUSTMENT_OPERATIONS and groups[-1][-1].name in ADJUSTMENT_OPERATIONS:
+            groups[-1].append(step)
+        else:
+            groups.append([step])
+    return groups
+
+
+def dumpSteps(steps):
+    return [{"name": step.name, "params": step.params} for step in steps]
+
+
+def loadSteps(data):
+    return tuple(Step(item["name"], **item.get("params", {})) for item in data)
+
+
+def saveRecipe(path, steps):
+    with open(path, "w") as file:
+        json.dump({"steps": dumpSteps(steps)}, file, indent=2)
+
+
+def loadRecipe(path):
+    with open(path) as file:
+        return loadSteps(json.load(file)["steps"])
+
+
+class Recipe:
+    # The document as its source image plus the steps applied to it. The output of every
+    # step is cached under the steps that led to it, so rendering a changed recipe starts
+    # from the longest prefix that is still cached and only runs the steps after it.
+    # `results` keeps the output of the slow operations across sessions and processes.
+    def __init__(self, cache_budget=256 * 2**20, remover=None, workers=None, results=None):
+        self.cache_budget = cache_budget
+        self.options = {"remover": remover, "workers": workers}
+        self.results = results
+
+        self.source = None
+        self.steps = ()
+
+        self.cache = OrderedDict()
+        self.cache_used = 0
+        # Bumped by reset, so a render that outlives its source cannot fill the new cache.
+        self.generation = 0
+        self._lock = threading.Lock()
+
+    def reset(self, source):
+        with self._lock:
+            self.cache.clear()
+            self.cache_used = 0
+            self.generation += 1
+            self.source = source
+        self.steps = ()
+
+    def cached(self, steps):
+        with self._lock:
+            for count in range(len(steps), 0, -1):
+                img = self.cache.get(steps[:count])
+                if img is not None:
+                    self.cache.move_to_end(steps[:count])
+                    return count, img, self.generation
+            return 0, self.source, self.generation
+
+    def store(self, steps, img, generation=None):
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            if steps in self.cache:
+                self.cache_used -= imageBytes(self.cache.pop(steps))
+            self.cache[steps] = img
+            self.cache_used += imageBytes(img)
+
+            # Least recently used first; the image just made is always kept.
+            while self.cache_used > self.cache_budget and len(self.cache) > 1:
+                unused, evicted = self.cache.popitem(last=False)
+                self.cache_used -= imageBytes(evicted)
+
+    def run(self, step, img, progress):
+        if self.results is None or step.name not in PERSISTENT_OPERATIONS:
+            return self.compute(step, img, progress)
+
+        with phase("result cache"):
+            key = self.results.key(img, step.key, self.settings(step))
+            result = self.results.get(key)
+        if result is None:
+            result = self.compute(step, img, progress)
+            self.results.put(key, result)
+        return result
+
+    def compute(self, step, img, progress):
+        return OPERATIONS[step.name](img, dict(self.options, progress=progress), **step.params)
+
+    def adjust(self, steps, img, progress):
+        pipeline = PointPipeline()
+        for step in steps:
+            getattr(pipeline, step.name)(**step.params)
+        return pipeline.apply(img, **tiled(dict(self.options, progress=progress)))
+
+    def settings(self, step):
+        # What else the result depends on besides the input and the step itself.
+        if step.name == "rembg":
+            remover = self.options["remover"]
+            return (remover.model_name, remover.proxy_size)
+        return ()
+
+    def render(self, steps=None, progress=None, optimize=True):
+        steps = self.steps if steps is None else tuple(steps)
+        count, img, generation = self.cached(steps)
+
+        # Only the part that has to be computed is reordered; its intermediate results are
+        # cached under the reordered steps, which describe the same images just as well.
+        prefix = steps[:count]
+        suffix = optimizeSteps(steps[count:], img.size) if optimize else steps[count:]
+
+        done = 0
+        for group in groupSteps(suffix):
+            def stepProgress(fraction):
+                if progress is not None:
+                    progress((done + fraction * len(group)) / len(suffix))
+
+            stepProgress(0)
+            with phase(" + ".join(step.name for step in group)):
+                if len(group) > 1:
+                    img = self.adjust(group, img, stepProgress)
+                else:
+                    img = self.run(group[0], img, stepProgress)
+            done += len(group)
+            if done < len(suffix):
+                self.store(prefix + suffix[:done], img, generation)
+
+        if count < len(steps):
+            self.store(steps, img, generation)
+        return img
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+
+# Bumped whenever an operation's output changes, so results of the old code are not reused.
+CACHE_VERSION = 1
+
+MAGIC = b"ARTMACHINE RESULT 1\n"
+
+
+def imageDigest(img, strip_height=256):
+    # Hashed a strip at a time so no full-size byte copy of the image is ever made. SHA-256
+    # runs in hardware on current CPUs, which makes it the quickest of hashlib's for this.
+    digest = hashlib.sha256()
+    digest.update(("%s %d %d" % (img.mode, img.width, img.height)).encode())
+    for top in range(0, img.height, strip_height):
+        digest.update(img.crop((0, top, img.width, min(top + strip_height, img.height))).tobytes())
+    return digest.hexdigest()[:32]
+
+
+def defaultDirectory():
+    if os.environ.get("ARTMACHINE_CACHE_DIR"):
+        return os.environ["ARTMACHINE_CACHE_DIR"]
+    if sys.platform == "win32":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+        return os.path.join(base, "Artmachine", "cache")
+    return os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "artmachine")
+
+
+class ResultCache:
+    # Results of expensive operations on disk, keyed by a hash of the input pixels, the
+    # operation and its parameters, so they survive restarts and are shared between the GUI
+    # and batch runs. Entries are stored as raw pixels (reading one back costs no decoding),
+    # written to a temporary file and renamed into place, so a crash never leaves a partial
+    # entry behind. The least recently used go first once `budget` bytes are exceeded; a
+    # read refreshes the file's modification time, which is what the order is based on.
+    def __init__(self, directory=None, budget=1024 * 2**20):
+        self.directory = directory or defaultDirectory()
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result-cache")
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, img, *parts):
+        description = repr((CACHE_VERSION,) + parts).encode()
+        return hashlib.sha256(imageDigest(img).encode() + description).hexdigest()[:40]
+
+    def path(self, key):
+        return os.path.join(self.directory, key + ".raw")
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                if file.readline() != MAGIC:
+                    raise ValueError("not a cached result")
+                mode, width, height = file.readline().decode().split()
+                img = Image.frombytes(mode, (int(width), int(height)), file.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # Damaged or from an incompatible version; it is dropped and made again.
+            self.remove(path)
+            return None
+
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return img
+
+    def put(self, key, img):
+        # Written in the background; the caller already has the result and need not wait.
+        if self.budget > 0:
+            self._writer.submit(self.write, key, img)
+
+    def flush(self):
+        self._writer.submit(lambda: None).result()
+
+    def write(self, key, img):
+        header = MAGIC + ("%s %d %d\n" % (img.mode, img.width, img.height)).encode()
+        handle, temporary = tempfile.mkstemp(prefix=".tmp-", dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as file:
+                file.write(header)
+                file.write(img.tobytes())
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path(key))
+        except OSError:
+            self.remove(temporary)
+            return
+        self.evict()
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            now = time.time()
+            for entry in os.scandir(self.directory):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                if entry.name.startswith(".tmp-"):
+                    # Left by a process that died while writing; other writers finish in seconds.
+                    if now - stat.st_mtime > 3600:
+                        self.remove(entry.path)
+                elif entry.name.endswith(".raw"):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+            used = sum(size for mtime, size, path in entries)
+            for mtime, size, path in sorted(entries):
+                if used <= self.budget:
+                    break
+                self.remove(path)
+                used -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
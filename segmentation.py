@@ -0,0 +1,175 @@
+import os
+import threading
+
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+from PIL import Image, ImageChops
+
+from resultcache import imageDigest
+from tiling import processTiled
+
+
+DEFAULT_MODEL = "u2net"
+PROXY_SIZE = 2048
+
+BACKGROUNDS = ["transparent", "white", "black"]
+BACKGROUND_COLORS = [None, (255, 255, 255), (0, 0, 0)]
+
+
+def compositeBackground(img, mask, color=None):
+    if color is None:
+        output = img.convert("RGBA")
+        if "A" in img.getbands():
+            mask = ImageChops.multiply(img.getchannel("A"), mask)
+        output.putalpha(mask)
+        return output
+
+    return Image.composite(img.convert("RGB"), Image.new("RGB", img.size, color), mask)
+
+
+def boxMean(array, radius):
+    # Mean over a (2r + 1)^2 window, one axis at a time from running sums; windows are
+    # clipped at the border.
+    for axis in (0, 1):
+        length = array.shape[axis]
+        shape = list(array.shape)
+        shape[axis] += 1
+        integral = np.zeros(shape, np.float32)
+        np.cumsum(array, axis=axis, out=integral[1:] if axis == 0 else integral[:, 1:])
+
+        upper = np.minimum(np.arange(length) + radius + 1, length)
+        lower = np.maximum(np.arange(length) - radius, 0)
+        counts = (upper - lower).reshape((-1, 1) if axis == 0 else (1, -1))
+        array = (np.take(integral, upper, axis) - np.take(integral, lower, axis)) / counts
+    return array.astype(np.float32)
+
+
+def guidedCoefficients(guide, source, radius, eps):
+    mean_guide = boxMean(guide, radius)
+    mean_source = boxMean(source, radius)
+    variance = boxMean(guide * guide, radius) - mean_guide * mean_guide
+    covariance = boxMean(guide * source, radius) - mean_guide * mean_source
+
+    a = covariance / (variance + eps)
+    b = mean_source - a * mean_guide
+    return boxMean(a, radius), boxMean(b, radius)
+
+
+def refineTile(tile, box, a, b, scale):
+    # Fast guided filter: the linear coefficients were fitted at proxy resolution, here they
+    # are upsampled for this tile and applied to the full resolution luminance.
+    proxy_box = tuple(value / scale for value in box)
+    a = np.asarray(a.resize(tile.size, Image.BILINEAR, box=proxy_box))
+    b = np.asarray(b.resize(tile.size, Image.BILINEAR, box=proxy_box))
+
+    refined = np.asarray(tile.convert("L"), dtype=np.float32) * a
+    refined += b * 255
+    np.clip(refined, 0, 255, out=refined)
+    refined += 0.5
+    return Image.fromarray(refined.astype(np.uint8))
+
+
+def refineMask(img, proxy, proxy_mask, radius=4, eps=1e-3, **options):
+    guide = np.asarray(proxy.convert("L"), dtype=np.float32) / 255
+    source = np.asarray(proxy_mask, dtype=np.float32) / 255
+    a, b = guidedCoefficients(guide, source, radius, eps)
+
+    a = Image.fromarray(a, "F")
+    b = Image.fromarray(b, "F")
+    return processTiled(img, partial(refineTile, a=a, b=b, scale=img.width / proxy.width), with_box=True, **options)
+
+
+def proxyImage(img, proxy_size):
+    scale = proxy_size / max(img.size)
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
+
+def createSession(model_name, threads=None):
+    # rembg brings onnxruntime, scipy and scikit-image with it, so it is only imported here,
+    # the first time a model is needed (usually by the warm-up thread).
+    from rembg import new_session
+
+    if not threads:
+        return new_session(model_name)
+
+    # rembg sizes the onnxruntime thread pools from OMP_NUM_THREADS when it builds the session.
+    previous = os.environ.get("OMP_NUM_THREADS")
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        return new_session(model_name)
+    finally:
+        if previous is None:
+            del os.environ["OMP_NUM_THREADS"]
+        else:
+            os.environ["OMP_NUM_THREADS"] = previous
+
+
+class BackgroundRemover:
+    def __init__(self, model_name=None, threads=None, cached_masks=4, proxy_size=None):
+        self.model_name = model_name or os.environ.get("ARTMACHINE_REMBG_MODEL", DEFAULT_MODEL)
+        self.threads = threads or int(os.environ.get("ARTMACHINE_REMBG_THREADS", 0))
+        if proxy_size is None:
+            proxy_size = int(os.environ.get("ARTMACHINE_REMBG_PROXY", 0))
+        self.proxy_size = proxy_size
+        self._session = None
+        self._lock = threading.Lock()
+
+        self.cached_masks = cached_masks
+        self.masks = OrderedDict()
+
+    def session(self):
+        with self._lock:
+            if self._session is None:
+                self._session = createSession(self.model_name, self.threads)
+            return self._session
+
+    def warmUp(self):
+        # Loads the model and runs one tiny inference, so the first real removal pays for neither.
+        from rembg import remove
+        remove(Image.new("RGB", (64, 64)), session=self.session())
+
+    def warmUpInBackground(self):
+        thread = threading.Thread(target=self._warmUp, name="rembg-warmup", daemon=True)
+        thread.start()
+        return thread
+
+    def _warmUp(self):
+        try:
+            self.warmUp()
+        except Exception:
+            # Most likely the model could not be downloaded; the first real removal reports it.
+            pass
+
+    def mask(self, img):
+        # The alpha mask only depends on the pixels and the model, so changing the background
+        # fill of an image state that was already segmented never runs the network again.
+        from rembg import remove
+
+        use_proxy = self.proxy_size and max(img.size) > self.proxy_size
+        key = (imageDigest(img), self.model_name, self.proxy_size if use_proxy else None)
+        with self._lock:
+            if key in self.masks:
+                self.masks.move_to_end(key)
+                return self.masks[key]
+
+        if use_proxy:
+            # The network sees a few hundred pixels either way; segmenting a proxy avoids
+            # decoding, matting and compositing at full size, and the mask edges are then
+            # recovered from the full resolution image.
+            proxy = proxyImage(img, self.proxy_size)
+            proxy_mask = remove(proxy, session=self.session(), only_mask=True)
+            mask = refineMask(img, proxy, proxy_mask)
+        else:
+            mask = remove(img, session=self.session(), only_mask=True)
+
+        with self._lock:
+            self.masks[key] = mask
+            while len(self.masks) > self.cached_masks:
+                self.masks.popitem(last=False)
+        return mask
+
+    def removeBackground(self, input, index=0):
+        return compositeBackground(input, self.mask(input), BACKGROUND_COLORS[index])
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import numpy as np
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def noiseImage(mode="RGB", size=(120, 90), seed=0):
+    # Seeded random pixels, so every test sees the same image and nothing is accidentally uniform.
+    pixels = np.random.RandomState(seed).randint(0, 256, (size[1], size[0], 4), np.uint8)
+    return Image.fromarray(pixels, "RGBA").convert(mode)
@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+
+from PIL import Image, ImageEnhance, ImageOps
+
+from adjustments import (PointPipeline, brightnessImage, contrastImage, eightBitImage, gammaImage, grayImage,
+                         invertImage)
+
+
+def deepImage(mode, size=(150, 100)):
+    values = np.random.RandomState(0).randint(0, 65536, (size[1], size[0])).astype(np.uint16)
+    img = Image.fromarray(values, "I;16")
+    return img if mode == "I;16" else img.convert(mode)
+
+
+def testEightBitImageKeepsTheTopBits():
+    img = deepImage("I;16")
+    expected = (np.asarray(img.convert("I")) // 256).astype(np.uint8)
+    assert eightBitImage(img).mode == "L"
+    assert (np.asarray(eightBitImage(img)) == expected).all()
+
+
+@pytest.mark.parametrize("mode", ["I;16", "I"])
+@pytest.mark.parametrize("operation, expected", [
+    (grayImage, lambda img: img),
+    (invertImage, ImageOps.invert),
+    (lambda img, **options: contrastImage(img, 1.6, **options), lambda img: ImageEnhance.Contrast(img).enhance(1.6)),
+    (lambda img, **options: brightnessImage(img, 0.7, **options), lambda img: ImageEnhance.Brightness(img).enhance(0.7)),
+    (lambda img, **options: gammaImage(img, 1.8, **options), lambda img: PointPipeline().gamma(1.8).apply(img)),
+])
+def testHighBitDepthImagesAreAdjustedAsTheirEightBitImage(mode, operation, expected):
+    img = deepImage(mode)
+    result = operation(img, tile_size=64, workers=2)
+    assert result.mode == "L"
+    assert result.tobytes() == expected(eightBitImage(img)).tobytes()
+
+
+def testFloatImagesAreAdjusted():
+    img = Image.fromarray(np.linspace(0, 255, 100 * 80, dtype=np.float32).reshape(80, 100), "F")
+    assert invertImage(img).tobytes() == ImageOps.invert(img.convert("L")).tobytes()
+
+
+def testOtherModesAreRefused():
+    with pytest.raises(ValueError):
+        invertImage(Image.new("CMYK", (4, 4)))
@@ -0,0 +1,42 @@
+import pytest
+
+from PIL import Image
+
+import batch
+from conftest import noiseImage
+from recipe import Recipe, Step
+
+
+class CutoutRemover:
+    # Stands in for rembg: keeps the left half of the picture.
+    model_name = "test"
+    proxy_size = 0
+
+    def removeBackground(self, img, background=0):
+        output = img.convert("RGBA")
+        alpha = Image.new("L", img.size, 0)
+        alpha.paste(255, (0, 0, img.width // 2, img.height))
+        output.putalpha(alpha)
+        return output
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    monkeypatch.setattr(batch, "recipe", Recipe(cache_budget=0, remover=CutoutRemover(), workers=1))
+
+
+@pytest.mark.parametrize("extension, mode", [(".jpg", "RGB"), (".png", "RGBA"), (".webp", "RGBA")])
+def testTransparentCutoutsAreSavedInEveryFormat(tmp_path, worker, extension, mode):
+    source = tmp_path / "source.png"
+    noiseImage("RGB").save(source)
+    destination = tmp_path / "out" / ("result" + extension)
+
+    pixels = batch.processFile(str(source), str(destination), (Step("rembg"),))
+
+    assert pixels == 120 * 90
+    with Image.open(destination) as img:
+        assert img.mode == mode
+        if extension == ".jpg":
+            # The cut away half is flattened onto white.
+            assert min(img.getpixel((110, 45))) > 240
+    assert not (tmp_path / "out" / ("result" + extension + ".part")).exists()
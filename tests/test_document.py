@@ -0,0 +1,100 @@
+import io
+
+import numpy as np
+import pytest
+
+from PIL import Image
+
+from document import (ORIENTATION_TAG, ImageDocument, decodeImage, exifOrientation, orientImage, setJpegOrientation,
+                      transposeOrientation)
+from recipe import TRANSPOSE_NAMES, Step
+
+
+def jpegBytes(exif=None, size=(64, 48)):
+    pixels = np.random.RandomState(0).randint(0, 256, (size[1], size[0], 3), np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, "JPEG", quality=85, **({"exif": exif} if exif is not None else {}))
+    return buffer.getvalue()
+
+
+def scanData(data):
+    # Everything from the start of scan marker on: the compressed image itself.
+    return data[data.index(b"\xff\xda"):]
+
+
+def withOrientation(orientation):
+    exif = Image.Exif()
+    exif[ORIENTATION_TAG] = orientation
+    return exif.tobytes()
+
+
+@pytest.mark.parametrize("exif", [None, withOrientation(1)], ids=["no exif", "exif"])
+@pytest.mark.parametrize("orientation", range(1, 9))
+def testSetJpegOrientationKeepsTheImageData(exif, orientation):
+    data = jpegBytes(exif)
+    patched = setJpegOrientation(data, orientation)
+
+    assert scanData(patched) == scanData(data)
+    with Image.open(io.BytesIO(patched)) as img:
+        assert exifOrientation(img) == orientation
+        assert img.tobytes() == Image.open(io.BytesIO(data)).tobytes()
+
+
+def testOrientationPatchedInPlaceRoundTrips():
+    data = jpegBytes(withOrientation(1))
+    rotated = setJpegOrientation(data, 6)
+    assert len(rotated) == len(data)
+    assert setJpegOrientation(rotated, 1) == data
+
+
+def testSetJpegOrientationRejectsOtherFiles():
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4)).save(buffer, "PNG")
+    assert setJpegOrientation(buffer.getvalue(), 6) is None
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+@pytest.mark.parametrize("method", list(TRANSPOSE_NAMES))
+def testTransposeOrientationComposes(orientation, method):
+    probe = Image.frombytes("L", (3, 2), bytes(range(6)))
+    expected = orientImage(probe, orientation).transpose(method)
+    assert orientImage(probe, transposeOrientation(orientation, method)).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("method", [Image.ROTATE_90, Image.ROTATE_180, Image.FLIP_LEFT_RIGHT])
+def testLosslessSaveOfARotatedJpeg(tmp_path, method):
+    source = tmp_path / "source.jpg"
+    source.write_bytes(jpegBytes(withOrientation(6)))
+
+    document = ImageDocument()
+    document.open(str(source))
+    document.setImage(document.image.transpose(method), (Step("transpose", method=method),))
+
+    target = tmp_path / "saved.jpg"
+    assert document.save(str(target), lossless=True)
+    assert scanData(target.read_bytes()) == scanData(source.read_bytes())
+    assert decodeImage(str(target))[0].tobytes() == document.image.tobytes()
+    assert not (tmp_path / "saved.jpg.part").exists()
+
+
+def testEditedImagesAreNotSavedLosslessly(tmp_path):
+    source = tmp_path / "source.jpg"
+    source.write_bytes(jpegBytes())
+
+    document = ImageDocument()
+    document.open(str(source))
+    document.setImage(document.image.point(lambda value: 255 - value), (Step("invert"),))
+    assert not document.canSaveLossless(str(tmp_path / "saved.jpg"))
+    assert not document.save(str(tmp_path / "saved.jpg"), lossless=True)
+
+
+def testCancelledSaveLeavesNothingBehind(tmp_path):
+    document = ImageDocument()
+    document.load(None, Image.new("RGB", (8, 8)), None, 1, {})
+
+    def cancel(fraction):
+        raise RuntimeError("cancelled")
+
+    with pytest.raises(RuntimeError):
+        document.save(str(tmp_path / "saved.png"), progress=cancel)
+    assert list(tmp_path.iterdir()) == []
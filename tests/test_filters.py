@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from PIL import ImageFilter, ImageMath
+
+from conftest import noiseImage
+from filters import SKETCH_RADIUS, dodgeArray, pencilSketch
+
+
+def imageMathDodge(grey, blur):
+    # The expression the app used before the NumPy kernel.
+    if hasattr(ImageMath, "lambda_eval"):
+        return ImageMath.lambda_eval(lambda args: args["convert"](args["a"] * 256 / args["b"], "L"), a=grey, b=blur)
+    return ImageMath.eval("convert(a * 256/b, 'L')", a=grey, b=blur)
+
+
+def testDodgeMatchesImageMath():
+    grey = noiseImage("L", (150, 100), 1)
+    blur = noiseImage("L", (150, 100), 2)
+    # Zeros and values around the clipping point are where the two could differ.
+    blur.paste(0, (0, 0, 20, 20))
+    grey.paste(255, (10, 10, 40, 40))
+
+    expected = imageMathDodge(grey, blur)
+    assert dodgeArray(np.asarray(grey), np.asarray(blur)).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA", "P"])
+def testPencilSketchMatchesTheOriginalFilter(mode):
+    img = noiseImage(mode, (150, 100))
+    grey = img.convert("L")
+    blur = grey.filter(ImageFilter.GaussianBlur(radius=SKETCH_RADIUS))
+    assert pencilSketch(img).tobytes() == imageMathDodge(grey, blur).tobytes()
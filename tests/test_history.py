@@ -0,0 +1,108 @@
+import os
+
+from conftest import noiseImage
+from history import History, Snapshot, TileDelta, changedTiles
+
+
+def edited(img, box, color=(255, 0, 0)):
+    img = img.copy()
+    img.paste(color, box)
+    return img
+
+
+def states(count=5):
+    # Each state paints a small patch over the previous one, so the history keeps tile deltas.
+    images = [noiseImage(size=(200, 150))]
+    for index in range(1, count):
+        images.append(edited(images[-1], (index * 20, index * 10, index * 20 + 15, index * 10 + 15),
+                             (index * 40, 0, 255 - index * 40)))
+    return images
+
+
+def push(history, images):
+    history.reset(images[0], 0)
+    for index, image in enumerate(images[1:], 1):
+        history.push(image, index)
+
+
+def testChangedTilesFindsOnlyTheEditedTiles():
+    img = noiseImage(size=(200, 150))
+    boxes = changedTiles(img, edited(img, (70, 70, 75, 75)), 64)
+    assert boxes == [(64, 64, 128, 128)]
+
+
+def testSmallEditsKeepTileDeltasAndLargeOnesSnapshots():
+    history = History(tile_size=32)
+    img = noiseImage(size=(200, 150))
+    assert isinstance(history.record(img, edited(img, (0, 0, 10, 10))), TileDelta)
+    assert isinstance(history.record(img, edited(img, (0, 0, 200, 150))), Snapshot)
+    assert isinstance(history.record(img, img.convert("L")), Snapshot)
+
+
+def testUndoAndRedoWalkBackAndForth():
+    images = states()
+    history = History(tile_size=32)
+    push(history, images)
+
+    for index in range(len(images) - 2, -1, -1):
+        assert history.undo().tobytes() == images[index].tobytes()
+        assert history.state() == index
+    assert not history.canUndo()
+
+    for index in range(1, len(images)):
+        assert history.redo().tobytes() == images[index].tobytes()
+    assert not history.canRedo()
+
+
+def testUndoDoesNotChangeImagesHandedIn():
+    images = states()
+    copies = [image.copy() for image in images]
+    history = History(tile_size=32)
+    push(history, images)
+    while history.canUndo():
+        history.undo()
+    assert all(image.tobytes() == copy.tobytes() for image, copy in zip(images, copies))
+
+
+def testEntriesOverTheMemoryBudgetSpillToDiskAndComeBack():
+    images = states(8)
+    history = History(memory_budget=4000, tile_size=32)
+    push(history, images)
+
+    assert history.spilled and history.memory_used <= history.memory_budget
+    spill_dir = history.spill_dir
+    assert os.listdir(spill_dir)
+
+    while history.canUndo():
+        history.undo()
+    assert history.current.tobytes() == images[0].tobytes()
+    while history.canRedo():
+        history.redo()
+    assert history.current.tobytes() == images[-1].tobytes()
+
+    history.close()
+    assert not os.path.exists(spill_dir)
+
+
+def testDiskBudgetForgetsTheOldestSteps():
+    images = states(8)
+    history = History(memory_budget=0, disk_budget=3000, tile_size=32)
+    push(history, images)
+
+    assert history.disk_used <= history.disk_budget
+    assert len(history.entries) < len(images) - 1
+    while history.canUndo():
+        history.undo()
+    assert history.state() == len(images) - 1 - len(history.entries)
+    history.close()
+
+
+def testPushAfterUndoDropsTheRedoBranch():
+    images = states()
+    history = History(tile_size=32)
+    push(history, images)
+    history.undo()
+    history.undo()
+    history.push(images[0], "branch")
+    assert not history.canRedo()
+    assert history.state() == "branch"
@@ -0,0 +1,131 @@
+import random
+import threading
+
+import pytest
+
+from PIL import Image
+
+from conftest import noiseImage
+from recipe import TRANSPOSE_NAMES, Recipe, Step, groupSteps, optimizeSteps, stepSize
+
+
+def renderStepByStep(img, steps):
+    recipe = Recipe(cache_budget=0)
+    for step in steps:
+        recipe.reset(img)
+        img = recipe.render((step,))
+    return img
+
+
+def randomAdjustment(generator):
+    name = generator.choice(["gray", "invert", "contrast", "brightness", "gamma"])
+    if name in ("gray", "invert"):
+        return Step(name)
+    return Step(name, **{"gamma" if name == "gamma" else "factor": round(generator.uniform(0.3, 2), 2)})
+
+
+class BlockingRemover:
+    model_name = "test"
+    proxy_size = 0
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def removeBackground(self, img, background=0):
+        self.started.set()
+        self.release.wait(10)
+        return img.convert("RGBA")
+
+
+def testRenderAfterResetDoesNotFillTheNewCache():
+    remover = BlockingRemover()
+    recipe = Recipe(remover=remover)
+    first, second = Image.new("RGB", (8, 8), "red"), Image.new("RGB", (8, 8), "blue")
+    steps = (Step("rembg"),)
+
+    recipe.reset(first)
+    worker = threading.Thread(target=recipe.render, args=(steps,))
+    worker.start()
+    remover.started.wait(10)
+    recipe.reset(second)
+    remover.release.set()
+    worker.join()
+
+    count, img, generation = recipe.cached(steps)
+    assert count == 0 and img is second
+
+
+def testGroupStepsJoinsConsecutiveAdjustments():
+    steps = (Step("invert"), Step("gamma", gamma=2), Step("sketch"), Step("gray"), Step("crop", box=(0, 0, 4, 4)))
+    assert [len(group) for group in groupSteps(steps)] == [2, 1, 1, 1]
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def testMergedAdjustmentsMatchStepByStep(mode):
+    generator = random.Random(mode)
+    img = noiseImage(mode)
+    for trial in range(20):
+        steps = tuple(randomAdjustment(generator) for index in range(generator.randint(2, 6)))
+        recipe = Recipe(cache_budget=0)
+        recipe.reset(img)
+        merged = recipe.render(steps)
+        expected = renderStepByStep(img, steps)
+        assert merged.mode == expected.mode and merged.tobytes() == expected.tobytes(), steps
+
+
+def randomStep(generator, size):
+    name = generator.choice(["crop", "crop", "transpose", "sketch", "invert", "gray", "gamma", "contrast"])
+    if name == "crop":
+        width, height = size
+        left, top = generator.randrange(width // 2 + 1), generator.randrange(height // 2 + 1)
+        right = left + generator.randint(1, width - left)
+        bottom = top + generator.randint(1, height - top)
+        return Step("crop", box=(left, top, right, bottom))
+    if name == "transpose":
+        return Step("transpose", method=generator.choice(list(TRANSPOSE_NAMES)))
+    if name == "sketch":
+        return Step("sketch", radius=generator.choice([1, 2.5, 4]))
+    if name == "gamma":
+        return Step("gamma", gamma=generator.uniform(0.5, 2))
+    if name == "contrast":
+        return Step("contrast", factor=generator.uniform(0.5, 2))
+    return Step(name)
+
+
+def randomRecipe(generator, size):
+    steps = []
+    for index in range(generator.randint(2, 7)):
+        steps.append(randomStep(generator, size))
+        size = stepSize(steps[-1], size)
+    return tuple(steps)
+
+
+def render(img, steps, optimize):
+    # A recipe of its own for each render, so nothing comes from the other one's cache.
+    recipe = Recipe(cache_budget=0)
+    recipe.reset(img)
+    return recipe.render(steps, optimize=optimize)
+
+
+def testOptimizedRecipesRenderTheSameImage():
+    reordered = 0
+    for seed in range(60):
+        generator = random.Random(seed)
+        img = noiseImage("RGB", (160, 120), seed)
+        steps = randomRecipe(generator, img.size)
+        optimized = optimizeSteps(steps, img.size)
+        reordered += optimized != steps
+
+        expected = render(img, steps, optimize=False)
+        result = render(img, steps, optimize=True)
+        assert result is not expected
+        assert result.size == expected.size and result.tobytes() == expected.tobytes(), (seed, steps, optimized)
+    # Enough of the random recipes are actually changed for the comparison to mean something.
+    assert reordered >= 20
+
+
+def testCropsMoveAheadOfTheSketch():
+    steps = (Step("sketch", radius=2), Step("crop", box=(40, 30, 80, 60)))
+    optimized = optimizeSteps(steps, (160, 120))
+    assert optimized[0].name == "crop" and optimized[1].name == "sketch"
@@ -0,0 +1,125 @@
+import os
+import time
+
+import pytest
+
+from PIL import Image
+
+from conftest import noiseImage
+from recipe import Recipe, Step
+from resultcache import MAGIC, ResultCache, imageDigest
+
+
+# Small, so entries stay a few KB and eviction budgets are easy to set.
+SIZE = (40, 30)
+
+
+def entries(cache):
+    return sorted(name for name in os.listdir(cache.directory) if name.endswith(".raw"))
+
+
+def age(cache, key, seconds):
+    path = cache.path(key)
+    stamp = time.time() - seconds
+    os.utime(path, (stamp, stamp))
+
+
+def testDigestDependsOnPixelsModeAndSize():
+    img = noiseImage(size=SIZE)
+    assert imageDigest(img) == imageDigest(img.copy())
+    assert imageDigest(img) != imageDigest(noiseImage(size=SIZE, seed=1))
+    assert imageDigest(img) != imageDigest(img.convert("RGBA"))
+    assert imageDigest(Image.new("L", (4, 6))) != imageDigest(Image.new("L", (6, 4)))
+
+
+def testKeyDependsOnTheParameters(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    img = noiseImage(size=SIZE)
+    assert cache.key(img, ("sketch", ("radius", 2))) != cache.key(img, ("sketch", ("radius", 3)))
+    assert cache.key(img, ("rembg",), ("u2net", 0)) != cache.key(img, ("rembg",), ("u2netp", 0))
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA", "I;16", "I", "F"])
+def testResultsComeBackUnchanged(tmp_path, mode):
+    cache = ResultCache(str(tmp_path), budget=2**20)
+    img = noiseImage("L", SIZE).convert(mode) if mode in ("I;16", "I", "F") else noiseImage(mode, SIZE)
+    cache.put("entry", img)
+    cache.flush()
+
+    result = cache.get("entry")
+    assert result.mode == img.mode and result.size == img.size and result.tobytes() == img.tobytes()
+    assert cache.get("missing") is None
+
+
+def testLeastRecentlyUsedEntriesAreEvicted(tmp_path):
+    img = noiseImage(size=SIZE)
+    entry = len(MAGIC) + 10 + len(img.tobytes())
+    cache = ResultCache(str(tmp_path), budget=3 * entry)
+    for index, key in enumerate(("a", "b", "c")):
+        cache.write(key, img)
+        age(cache, key, 100 - index)
+
+    # Reading "a" makes it the most recently used, so "b" goes first.
+    assert cache.get("a") is not None
+    cache.write("d", img)
+    assert entries(cache) == ["a.raw", "c.raw", "d.raw"]
+
+
+def testEntriesLargerThanTheBudgetAreNotKept(tmp_path):
+    cache = ResultCache(str(tmp_path), budget=100)
+    cache.write("big", noiseImage(size=SIZE))
+    assert entries(cache) == []
+
+
+def testZeroBudgetWritesNothing(tmp_path):
+    cache = ResultCache(str(tmp_path), budget=0)
+    cache.put("entry", noiseImage(size=SIZE))
+    cache.flush()
+    assert entries(cache) == []
+
+
+@pytest.mark.parametrize("damage", ["truncated", "header", "empty"])
+def testDamagedEntriesAreDroppedAndMissed(tmp_path, damage):
+    cache = ResultCache(str(tmp_path))
+    cache.write("entry", noiseImage(size=SIZE))
+    path = cache.path("entry")
+    if damage == "truncated":
+        with open(path, "r+b") as file:
+            file.truncate(os.path.getsize(path) // 2)
+    elif damage == "header":
+        with open(path, "r+b") as file:
+            file.write(b"garbage")
+    else:
+        open(path, "wb").close()
+
+    assert cache.get("entry") is None
+    assert not os.path.exists(path)
+
+
+def testStaleTemporaryFilesAreCleanedUp(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    stale, fresh = tmp_path / ".tmp-stale", tmp_path / ".tmp-fresh"
+    stale.write_bytes(b"partial")
+    fresh.write_bytes(b"partial")
+    os.utime(stale, (time.time() - 7200, time.time() - 7200))
+
+    cache.write("entry", noiseImage(size=SIZE))
+    assert not stale.exists() and fresh.exists()
+
+
+def testRecipeReusesCachedResults(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    img = noiseImage(size=(80, 60))
+    steps = (Step("sketch", radius=2),)
+
+    first = Recipe(results=cache)
+    first.reset(img)
+    expected = first.render(steps)
+    cache.flush()
+    assert len(entries(cache)) == 1
+
+    # A new recipe, as in a later session, finds the result on disk; the sketch is not run.
+    second = Recipe(results=cache)
+    second.compute = None
+    second.reset(img.copy())
+    assert second.render(steps).tobytes() == expected.tobytes()
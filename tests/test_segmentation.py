@@ -0,0 +1,37 @@
+import numpy as np
+
+from PIL import Image, ImageDraw
+
+from segmentation import compositeBackground, proxyImage, refineMask
+
+
+def diskImage(size=(1200, 900)):
+    mask = Image.new("L", size)
+    ImageDraw.Draw(mask).ellipse((size[0] // 5, size[1] // 6, size[0] * 4 // 5, size[1] * 5 // 6), fill=255)
+    img = Image.merge("RGB", [mask.point(lambda value: 40 + value * 0.7)] * 3)
+    return img, mask
+
+
+def meanError(mask, expected):
+    return np.abs(np.asarray(mask, np.float32) - np.asarray(expected, np.float32)).mean()
+
+
+def testRefinedMaskIsAtLeastAsGoodAsUpsampling():
+    img, mask = diskImage()
+    proxy = proxyImage(img, 256)
+    proxy_mask = proxyImage(mask, 256)
+
+    refined = refineMask(img, proxy, proxy_mask)
+    upsampled = proxy_mask.resize(img.size, Image.BILINEAR)
+
+    assert refined.size == img.size
+    assert meanError(refined, mask) <= meanError(upsampled, mask)
+    # The inside of the disk stays fully opaque.
+    assert refined.getpixel((img.width // 2, img.height // 2)) == 255
+
+
+def testCompositeBackground():
+    img, mask = diskImage((40, 30))
+    assert compositeBackground(img, mask).mode == "RGBA"
+    white = compositeBackground(img, mask, (255, 255, 255))
+    assert white.getpixel((0, 0)) == (255, 255, 255)
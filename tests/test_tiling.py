@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from PIL import ImageEnhance
+
+from conftest import noiseImage
+from adjustments import brightnessImage, contrastImage
+from filters import pencilSketch, sketchImage
+from tiling import processTiled, tileBoxes
+
+
+def testTileBoxesCoverTheImageOnce():
+    covered = np.zeros((200, 300), np.int32)
+    for left, top, right, bottom in tileBoxes((300, 200), 64):
+        covered[top:bottom, left:right] += 1
+    assert (covered == 1).all()
+
+
+@pytest.mark.parametrize("radius", [1, 2.5, 6])
+def testTiledSketchHasNoSeams(radius):
+    img = noiseImage("RGB", (300, 200))
+    tiled = sketchImage(img, radius, tile_size=64, workers=2)
+    assert tiled.tobytes() == pencilSketch(img, radius).tobytes()
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+def testTiledContrastMatchesImageEnhance(mode):
+    img = noiseImage(mode, (300, 200))
+    expected = ImageEnhance.Contrast(img).enhance(1.7)
+    assert contrastImage(img, 1.7, tile_size=64, workers=2).tobytes() == expected.tobytes()
+
+
+@pytest.mark.parametrize("mode", ["L", "RGB"])
+def testTiledBrightnessMatchesImageEnhance(mode):
+    img = noiseImage(mode, (300, 200))
+    expected = ImageEnhance.Brightness(img).enhance(0.6)
+    assert brightnessImage(img, 0.6, tile_size=64, workers=2).tobytes() == expected.tobytes()
+
+
+def testProgressReachesOne():
+    seen = []
+    processTiled(noiseImage("L", (300, 200)), lambda tile: tile, tile_size=64, workers=2, progress=seen.append)
+    assert seen[-1] == 1
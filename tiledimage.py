@@ -0,0 +1,266 @@
+import math
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+from adjustments import eightBitImage
+
+from PySide6.QtCore import QRectF, QRunnable, QThreadPool, Signal
+from PySide6.QtGui import QImage, QPainter
+from PySide6.QtWidgets import QGraphicsItem, QGraphicsObject
+
+
+TILE_SIZE = 256
+
+
+def reduceImage(img):
+    if img.mode == "I;16":
+        img = img.convert("I")
+    return img.reduce(2)
+
+
+def fitImage(img, width, height):
+    # A copy no larger than width x height to work on at screen size, and how many image
+    # pixels each of its pixels spans along x and y.
+    scale = min(1, width / img.width, height / img.height)
+    if scale >= 1:
+        return img, (1.0, 1.0)
+
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    if img.mode == "I;16":
+        img = img.convert("I")
+    proxy = img.resize(size, Image.BILINEAR, reducing_gap=2.0)
+    return proxy, (img.width / size[0], img.height / size[1])
+
+
+# Pillow raw mode and QImage format for each mode that can be shown as is. RGB is padded to
+# Qt's native 32-bit layout and RGBA premultiplied, the two formats Qt paints fastest.
+QIMAGE_FORMATS = {
+    "L": ("L", QImage.Format_Grayscale8, 1),
+    "RGB": ("BGRX", QImage.Format_RGB32, 4),
+    "RGBA": ("BGRa", QImage.Format_ARGB32_Premultiplied, 4),
+}
+
+ARRAY_FORMATS = {1: QImage.Format_Grayscale8, 3: QImage.Format_RGB888, 4: QImage.Format_RGBA8888}
+
+
+class BufferImage(QImage):
+    # A QImage over memory it does not own; the buffer is kept alive as long as the image.
+    def __init__(self, buffer, width, height, bytes_per_line, format):
+        super().__init__(buffer, width, height, bytes_per_line, format)
+        self.buffer = buffer
+
+
+def imageToQImage(data):
+    # PIL images are packed straight into Qt's layout, one copy and no encoding; uint8 NumPy
+    # arrays of shape (h, w), (h, w, 3) or (h, w, 4) are wrapped without copying at all.
+    if isinstance(data, np.ndarray):
+        channels = 1 if data.ndim == 2 else data.shape[-1]
+        if data.dtype != np.uint8 or data.ndim not in (2, 3) or channels not in ARRAY_FORMATS:
+            raise ValueError("cannot show an array of %s %s" % (data.dtype, data.shape))
+        data = np.ascontiguousarray(data)
+        return BufferImage(data, data.shape[1], data.shape[0], data.strides[0], ARRAY_FORMATS[channels])
+
+    # Qt only gets 8-bit tiles.
+    img = eightBitImage(data)
+    rawmode, format, pixel_bytes = QIMAGE_FORMATS[img.mode]
+    return BufferImage(img.tobytes("raw", rawmode), img.width, img.height, img.width * pixel_bytes, format)
+
+
+class Pyramid:
+    # The image and its power-of-two reductions down to a single tile. Each level is made
+    # from the one above the first time something asks for it.
+    def __init__(self, image):
+        self.levels = [image]
+        self.count = 1
+        while max(image.size) > TILE_SIZE << (self.count - 1):
+            self.count += 1
+        self._lock = threading.Lock()
+
+    def level(self, index):
+        if index < len(self.levels):
+            return self.levels[index]
+        with self._lock:
+            while len(self.levels) <= index:
+                self.levels.append(reduceImage(self.levels[-1]))
+            return self.levels[index]
+
+
+class TileJob(QRunnable):
+    def __init__(self, item, generation, pyramid, key):
+        super().__init__()
+        self.item = item
+        self.generation = generation
+        self.pyramid = pyramid
+        self.key = key
+
+    def run(self):
+        # Requests pile up while panning fast; the ones that scrolled out of view are dropped.
+        if not self.item.isWanted(self.generation, self.key):
+            self.item.dropRequest(self.generation, self.key)
+            return
+
+        level, column, row = self.key
+        img = self.pyramid.level(level)
+        box = (column * TILE_SIZE, row * TILE_SIZE,
+               min((column + 1) * TILE_SIZE, img.width), min((row + 1) * TILE_SIZE, img.height))
+        tile = imageToQImage(img.crop(box))
+        try:
+            self.item.tileLoaded.emit(self.generation, self.key, tile)
+        except RuntimeError:
+            # The view was closed while this tile was being made.
+            pass
+
+
+class TiledImageItem(QGraphicsObject):
+    # Shows a PIL image of any size as a mipmapped grid of tiles. Only the tiles in view are
+    # drawn, from the pyramid level closest to the current zoom; missing ones are made on
+    # worker threads and stand in as a blurry piece of a coarser level until they arrive.
+    # Tiles that have not been drawn for a while are the first to go when the cache is full.
+    tileLoaded = Signal(int, object, object)
+
+    def __init__(self, cache_tiles=768, parent=None):
+        super().__init__(parent)
+        self.setFlag(QGraphicsItem.ItemUsesExtendedStyleOption)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(2)
+
+        self.cache_tiles = cache_tiles
+        self.pyramid = None
+        self.size = (0, 0)
+        self.generation = 0
+
+        self.tiles = OrderedDict()
+        self.requested = set()
+        self.wanted = set()
+        self._lock = threading.Lock()
+
+        self.tileLoaded.connect(self.storeTile)
+
+    def setImage(self, image, dirty=None):
+        # `dirty` lists the boxes that differ from the image shown so far; tiles clear of all
+        # of them are kept, at every level, since each tile only depends on its own area.
+        if self.pyramid is not None and image is self.pyramid.levels[0]:
+            return
+
+        self.prepareGeometryChange()
+        self.generation += 1
+        if dirty is None or image is None or image.size != self.size:
+            self.tiles.clear()
+        else:
+            for key in list(self.tiles):
+                rect = self.tileRect(key)
+                if any(rect.intersects(QRectF(left, top, right - left, bottom - top))
+                       for left, top, right, bottom in dirty):
+                    del self.tiles[key]
+        with self._lock:
+            self.requested.clear()
+            self.wanted.clear()
+
+        self.pyramid = Pyramid(image) if image is not None else None
+        self.size = image.size if image is not None else (0, 0)
+        if self.pyramid is not None:
+            # The coarsest level is the fallback for everything else, so it is always made first.
+            self.request([(self.pyramid.count - 1, 0, 0)])
+        self.update()
+
+    def boundingRect(self):
+        return QRectF(0, 0, self.size[0], self.size[1])
+
+    def levelFor(self, scale):
+        if scale >= 1:
+            return 0
+        return max(0, min(self.pyramid.count - 1, int(math.floor(math.log2(1 / scale)))))
+
+    def tileRect(self, key):
+        level, column, row = key
+        span = TILE_SIZE << level
+        return QRectF(column * span, row * span,
+                      min(span, self.size[0] - column * span), min(span, self.size[1] - row * span))
+
+    def tileKeys(self, level, rect):
+        span = TILE_SIZE << level
+        rect = rect.intersected(self.boundingRect())
+        if rect.isEmpty():
+            return []
+        columns = range(int(rect.left()) // span, int(math.ceil(rect.right())) // span + 1)
+        rows = range(int(rect.top()) // span, int(math.ceil(rect.bottom())) // span + 1)
+        return [(level, column, row) for row in rows for column in columns
+                if column * span < self.size[0] and row * span < self.size[1]]
+
+    def paint(self, painter, option, widget=None):
+        if self.pyramid is None:
+            return
+
+        transform = painter.worldTransform()
+        scale = math.hypot(transform.m11(), transform.m12())
+        if scale < 1:
+            painter.setRenderHint(QPainter.SmoothPixmapTransform)
+
+        level = self.levelFor(scale)
+        missing = []
+        for key in self.tileKeys(level, option.exposedRect):
+            tile = self.tiles.get(key)
+            if tile is None:
+                missing.append(key)
+                self.drawFallback(painter, key)
+            else:
+                self.tiles.move_to_end(key)
+                painter.drawImage(self.tileRect(key), tile)
+
+        # Everything in the view stays wanted, not just the part this call had to repaint.
+        visible = option.exposedRect
+        if widget is not None:
+            visible = transform.inverted()[0].mapRect(QRectF(widget.rect()))
+        self.request(missing, self.tileKeys(level, visible))
+
+    def drawFallback(self, painter, key):
+        level, column, row = key
+        target = self.tileRect(key)
+        for coarser in range(level + 1, self.pyramid.count):
+            shift = coarser - level
+            parent = (coarser, column >> shift, row >> shift)
+            tile = self.tiles.get(parent)
+            if tile is not None:
+                origin = self.tileRect(parent)
+                factor = 1 / (1 << coarser)
+                source = QRectF((target.left() - origin.left()) * factor, (target.top() - origin.top()) * factor,
+                                target.width() * factor, target.height() * factor)
+                painter.drawImage(target, tile, source)
+                self.tiles.move_to_end(parent)
+                return
+
+    def request(self, keys, wanted=None):
+        with self._lock:
+            self.wanted = set(keys if wanted is None else wanted)
+            for key in keys:
+                if key not in self.requested:
+                    self.requested.add(key)
+                    self.pool.start(TileJob(self, self.generation, self.pyramid, key))
+
+    def isWanted(self, generation, key):
+        with self._lock:
+            return generation == self.generation and (key in self.wanted or key[0] == self.pyramid.count - 1)
+
+    def dropRequest(self, generation, key):
+        with self._lock:
+            if generation == self.generation:
+                self.requested.discard(key)
+
+    def storeTile(self, generation, key, tile):
+        if generation != self.generation:
+            return
+        with self._lock:
+            self.requested.discard(key)
+
+        self.tiles[key] = tile
+        while len(self.tiles) > self.cache_tiles:
+            oldest = next(iter(self.tiles))
+            if oldest[0] == self.pyramid.count - 1:
+                self.tiles.move_to_end(oldest)
+            else:
+                del self.tiles[oldest]
+        self.update(self.tileRect(key))
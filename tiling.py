@@ -0,0 +1,75 @@
+import math
+import os
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from PIL import Image
+
+
+TILE_SIZE = 1024
+
+
+def gaussianHalo(radius, passes=3):
+    # PIL approximates the gaussian with `passes` box blurs, each reaching at most radius + 1 pixels.
+    return int(math.ceil(passes * radius)) + passes
+
+
+def tileBoxes(size, tile_size=TILE_SIZE):
+    width, height = size
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            yield (left, top, min(left + tile_size, width), min(top + tile_size, height))
+
+
+def haloBox(box, halo, size):
+    left, top, right, bottom = box
+    return (max(left - halo, 0), max(top - halo, 0), min(right + halo, size[0]), min(bottom + halo, size[1]))
+
+
+def processTile(operation, tile, inner, box=None):
+    if box is None:
+        return operation(tile).crop(inner)
+    return operation(tile, box).crop(inner)
+
+
+def processTiled(image, operation, halo=0, tile_size=TILE_SIZE, workers=None, processes=False, progress=None,
+                 with_box=False):
+    # operation(tile) must return an image of the same size as the tile it was given; it is
+    # run on every tile grown by `halo` pixels and only the inner part is kept, so any filter
+    # whose reach is within the halo stitches back without seams. With `with_box` the operation
+    # is also told where the grown tile sits, as operation(tile, box).
+    if image.width <= tile_size and image.height <= tile_size:
+        if with_box:
+            return operation(image, (0, 0) + image.size)
+        return operation(image)
+
+    boxes = list(tileBoxes(image.size, tile_size))
+    workers = workers or os.cpu_count() or 1
+    executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+
+    output = None
+    pending = {}
+    done = 0
+
+    with executor(max_workers=workers) as pool:
+        # Only a couple of tiles per worker are cut out at any time to keep memory bounded.
+        while boxes or pending:
+            while boxes and len(pending) < 2 * workers:
+                box = boxes.pop(0)
+                outer = haloBox(box, halo, image.size)
+                inner = (box[0] - outer[0], box[1] - outer[1], box[2] - outer[0], box[3] - outer[1])
+                pending[pool.submit(processTile, operation, image.crop(outer), inner, outer if with_box else None)] = box
+
+            finished, unused = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                box = pending.pop(future)
+                tile = future.result()
+                if output is None:
+                    output = Image.new(tile.mode, image.size)
+                output.paste(tile, box[:2])
+
+                done += 1
+                if progress is not None:
+                    progress(done / (done + len(pending) + len(boxes)))
+
+    return output